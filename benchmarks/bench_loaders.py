@@ -0,0 +1,323 @@
+"""
+measure the throughput and the CPU the loaders spend around the requests,
+against the mock API server of mock_server.py instead of the real APIs
+
+    python benchmarks/bench_loaders.py [--models chatgptapi] [--workers 1,8]
+        [--accumulated-num 1] [--stream] [--latency uniform:0.01:0.05]
+        [--error-rate 0.02] [--save baseline.json | --compare baseline.json]
+        [--log-level warning] [book ...]
+
+the books of test_books/ and two synthetic big books (an epub and a txt) are
+used when none is given. Every case runs in a process of its own, which
+reports its paragraphs and requests per second, the CPU seconds of every
+stage (loading, rendering and writing the book, and the client: requests,
+scheduling, journal) and its peak RSS. `--save` keeps the results as a JSON
+baseline, `--compare` reports the changes against one and fails when the CPU
+or the throughput of a case got worse than `--tolerance`.
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from book_maker.log import LOG_LEVELS, setup_logging  # noqa: E402
+from mock_server import add_server_arguments, server_from_options  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+STAGES = ("load", "render", "write")
+# the vocabulary of the synthetic books
+WORDS = (
+    "the animals farm night was and of to a in he had that it his they with"
+    " comrades windmill pigs snowball napoleon boxer rebellion harvest"
+).split()
+
+
+def make_synthetic_epub(path, chapters=40, paragraphs=60):
+    from ebooklib import epub
+
+    rng = random.Random(1)
+    book = epub.EpubBook()
+    book.set_identifier("synthetic")
+    book.set_title("Synthetic")
+    book.set_language("en")
+    items = []
+    for c in range(chapters):
+        item = epub.EpubHtml(title=f"Chapter {c}", file_name=f"c{c}.xhtml", lang="en")
+        body = [f"<h1>Chapter {c}</h1>"]
+        for i in range(paragraphs):
+            words = " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 120)))
+            body.append(f"<p class='text'>{c}.{i} <i>{words}</i> end.</p>")
+        item.content = "<html><body>" + "\n".join(body) + "</body></html>"
+        book.add_item(item)
+        items.append(item)
+    book.toc = [epub.Link(i.file_name, i.title, i.file_name[:-6]) for i in items]
+    book.add_item(epub.EpubNcx())
+    book.spine = items
+    epub.write_epub(path, book)
+
+
+def make_synthetic_txt(path, lines=3000):
+    rng = random.Random(1)
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(lines):
+            words = " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 80)))
+            f.write(f"{i} {words}.\n\n")
+
+
+class StageTimer:
+    """CPU seconds spent in the wrapped methods, by stage, a method called
+    from another one only counts for its own stage"""
+
+    def __init__(self):
+        self.cpu = dict.fromkeys(STAGES, 0.0)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def wrap(self, cls, name, stage):
+        fn = getattr(cls, name)
+
+        def wrapper(*args, **kwargs):
+            stack = self.local.__dict__.setdefault("stack", [])
+            start = time.thread_time()
+            stack.append(0.0)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.thread_time() - start
+                inner = stack.pop()
+                if stack:
+                    stack[-1] += elapsed
+                with self.lock:
+                    self.cpu[stage] += elapsed - inner
+
+        setattr(cls, name, wrapper)
+
+
+def run_case(case):
+    """run one case in this process and return its measures"""
+    from book_maker.loader import BOOK_LOADER_DICT
+    from book_maker.loader.epub_loader import EPUBBookLoader
+    from book_maker.loader.txt_loader import TXTBookLoader
+    from book_maker.translator import MODEL_DICT
+
+    timer = StageTimer()
+    timer.wrap(EPUBBookLoader, "__init__", "load")
+    timer.wrap(EPUBBookLoader, "_load_chapters", "load")
+    timer.wrap(EPUBBookLoader, "_finish_chapter", "render")
+    timer.wrap(EPUBBookLoader, "_write_chapter", "write")
+    timer.wrap(TXTBookLoader, "__init__", "load")
+    timer.wrap(TXTBookLoader, "_write_output", "write")
+    paragraphs = []
+    scan = EPUBBookLoader._scan_paragraphs
+
+    def count_paragraphs(self, chapters):
+        result = scan(self, chapters)
+        paragraphs.append(result[0])
+        return result
+
+    EPUBBookLoader._scan_paragraphs = count_paragraphs
+
+    base = case["base"]
+    api_base = {"chatgptapi": f"{base}/v1", "gpt3": f"{base}/"}.get(case["model"])
+    book_type = case["book"].split(".")[-1]
+    kwargs = {}
+    if book_type == "txt":
+        kwargs = {"translate_tags": "p", "allow_navigable_strings": False}
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    loader = BOOK_LOADER_DICT[book_type](
+        case["book"],
+        MODEL_DICT[case["model"]],
+        "bench-key",
+        False,
+        language="Simplified Chinese",
+        model_api_base=api_base,
+        accumulated_num=case["accumulated_num"],
+        workers=case["workers"],
+        **kwargs,
+    )
+    model = loader.translate_model
+    if case["model"] == "google":
+        model.api_url = model.api_url.replace("https://translate.google.com", base)
+    model.max_retries = 50
+    model.stream = case["stream"]
+    loader.make_bilingual_book()
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    if book_type == "txt":
+        paragraphs.append(loader.index)
+    name, _ = os.path.splitext(case["book"])
+    return {
+        "ok": os.path.exists(f"{name}_bilingual.{book_type}"),
+        "paragraphs": sum(paragraphs),
+        "wall": wall,
+        "cpu": {
+            **timer.cpu,
+            "client": cpu - sum(timer.cpu.values()),
+            "total": cpu,
+        },
+        # kilobytes on linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def server_stats(base):
+    with urllib.request.urlopen(f"{base}/stats") as r:
+        return json.load(r)
+
+
+def measure(case, tmp):
+    """run `case` in a new process on a copy of its book"""
+    book = os.path.join(tmp, os.path.basename(case["path"]))
+    shutil.copy(case["path"], book)
+    result_path = os.path.join(tmp, "result.json")
+    child = {**case, "book": book, "result": result_path}
+    before = server_stats(case["base"])
+    # the child logs at --log-level, the progress bar and the log on stderr
+    # are only shown when the case fails
+    run = subprocess.run(
+        [sys.executable, __file__, "--child", json.dumps(child)],
+        stderr=subprocess.PIPE,
+    )
+    if run.returncode != 0:
+        sys.stderr.write(run.stderr.decode(errors="replace"))
+        run.check_returncode()
+    after = server_stats(case["base"])
+    with open(result_path) as f:
+        result = json.load(f)
+    for key in ("requests", "errors", "prompt_tokens", "completion_tokens"):
+        result[key] = after[key] - before[key]
+    result["paragraphs_per_s"] = result["paragraphs"] / result["wall"]
+    result["requests_per_s"] = result["requests"] / result["wall"]
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """print the changes against `baseline`, return the regressed cases"""
+    regressed = []
+    print(f"\n{'case':<44}{'cpu':>10}{'para/s':>10}")
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        cpu = result["cpu"]["total"] / max(old["cpu"]["total"], 1e-9) - 1
+        speed = result["paragraphs_per_s"] / max(old["paragraphs_per_s"], 1e-9) - 1
+        if cpu > tolerance or speed < -tolerance:
+            regressed.append(name)
+        print(f"{name[:43]:<44}{cpu:>+10.1%}{speed:>+10.1%}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("books", nargs="*")
+    parser.add_argument("--models", default="chatgptapi")
+    parser.add_argument("--workers", default="1,8")
+    parser.add_argument(
+        "--accumulated-num", dest="accumulated_num", type=int, default=1
+    )
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--no-synthetic", dest="synthetic", action="store_false")
+    parser.add_argument("--save")
+    parser.add_argument("--compare")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument(
+        "--log-level", dest="log_level", choices=LOG_LEVELS, default="warning"
+    )
+    parser.add_argument("--child")
+    add_server_arguments(parser)
+    options = parser.parse_args()
+
+    if options.child:
+        case = json.loads(options.child)
+        log_listener = setup_logging(case["log_level"])
+        try:
+            result = run_case(case)
+        finally:
+            log_listener.stop()
+        with open(case["result"], "w") as f:
+            json.dump(result, f)
+        return
+
+    server = server_from_options(options)
+    base = server.start()
+    tmp = tempfile.mkdtemp()
+    try:
+        books = options.books
+        if not books:
+            books = [
+                book
+                for book in sorted(glob.glob(os.path.join(ROOT, "test_books/*")))
+                if book.endswith((".epub", ".txt")) and "_bilingual" not in book
+            ]
+            if options.synthetic:
+                synthetic = os.path.join(tmp, "synthetic")
+                os.makedirs(synthetic)
+                make_synthetic_epub(os.path.join(synthetic, "synthetic_big.epub"))
+                make_synthetic_txt(os.path.join(synthetic, "synthetic_big.txt"))
+                books += sorted(glob.glob(os.path.join(synthetic, "*")))
+
+        results = {}
+        print(
+            f"{'case':<44}{'para/s':>9}{'req/s':>9}{'load':>8}{'render':>8}"
+            f"{'write':>8}{'client':>8}{'rss MB':>8}"
+        )
+        for book in books:
+            for model in options.models.split(","):
+                for workers in [int(w) for w in options.workers.split(",")]:
+                    name = f"{os.path.basename(book)}:{model}:w{workers}"
+                    case = {
+                        "path": book,
+                        "base": base,
+                        "model": model,
+                        "workers": workers,
+                        "accumulated_num": options.accumulated_num,
+                        "stream": options.stream,
+                        "log_level": options.log_level,
+                    }
+                    run_dir = os.path.join(tmp, "run")
+                    os.makedirs(run_dir)
+                    try:
+                        result = measure(case, run_dir)
+                    finally:
+                        shutil.rmtree(run_dir)
+                    results[name] = result
+                    cpu = result["cpu"]
+                    print(
+                        f"{name[:43]:<44}{result['paragraphs_per_s']:>9.1f}"
+                        f"{result['requests_per_s']:>9.1f}{cpu['load']:>8.2f}"
+                        f"{cpu['render']:>8.2f}{cpu['write']:>8.2f}"
+                        f"{cpu['client']:>8.2f}{result['peak_rss_mb']:>8.0f}"
+                        + ("" if result["ok"] else "  FAILED")
+                    )
+    finally:
+        server.stop()
+        shutil.rmtree(tmp)
+
+    if options.save:
+        settings = {k: v for k, v in vars(options).items() if k not in ("child",)}
+        with open(options.save, "w") as f:
+            json.dump({"settings": settings, "cases": results}, f, indent=2)
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)["cases"]
+        regressed = compare(results, baseline, options.tolerance)
+        if regressed:
+            print(f"regressed: {', '.join(regressed)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
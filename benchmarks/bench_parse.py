@@ -0,0 +1,74 @@
+"""
+time the BeautifulSoup backends on the documents of some epubs, a full parse
+(needed to render a chapter) against the selective parse of the elements to
+translate (enough to read their texts)
+
+    python benchmarks/bench_parse.py [--translate-tags p] [--repeat 5] [epub ...]
+
+the books of test_books/ are used when none is given
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ebooklib import ITEM_DOCUMENT  # noqa: E402
+
+from book_maker.loader import PARSERS  # noqa: E402
+from book_maker.loader.epub_chapter import parse_chapter  # noqa: E402
+from book_maker.loader.epub_stream import read_epub  # noqa: E402
+
+
+def available_parsers():
+    parsers = []
+    for parser in PARSERS:
+        try:
+            parse_chapter(b"<p>x</p>", ["p"], parser=parser)
+        except Exception:
+            # html5lib is not installed
+            continue
+        parsers.append(parser)
+    return parsers
+
+
+def bench(contents, trans_taglist, parser, selective, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for content in contents:
+            parse_chapter(content, trans_taglist, parser=parser, selective=selective)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    root = os.path.join(os.path.dirname(__file__), "..")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("books", nargs="*")
+    parser.add_argument("--translate-tags", dest="translate_tags", default="p")
+    parser.add_argument("--repeat", type=int, default=5)
+    options = parser.parse_args()
+    books = options.books or sorted(glob.glob(os.path.join(root, "test_books/*.epub")))
+    trans_taglist = options.translate_tags.split(",")
+    parsers = available_parsers()
+
+    print(f"{'book':<32}{'parser':<14}{'full ms':>10}{'selective ms':>14}")
+    for book in books:
+        contents = [
+            item.content for item in read_epub(book).get_items_of_type(ITEM_DOCUMENT)
+        ]
+        for backend in parsers:
+            full = bench(contents, trans_taglist, backend, False, options.repeat)
+            selective = bench(contents, trans_taglist, backend, True, options.repeat)
+            print(
+                f"{os.path.basename(book)[:31]:<32}{backend:<14}"
+                f"{full * 1000:>10.1f}{selective * 1000:>14.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""
+a local stand-in for the OpenAI and Google Translate APIs, to measure the
+tool without the network and without paying for it
+
+    python benchmarks/mock_server.py [--port 8000] [--latency uniform:0.01:0.05]
+        [--error-rate 0.02] [--error-status 429,500] [--retry-after 0.05]
+
+it answers /v1/chat/completions (streamed too), /v1/completions and
+/translate_a/single with a fake translation of the text, and reports the
+requests, injected errors and tokens it saw on /stats
+
+a latency is `fixed:SECONDS`, `uniform:LOW:HIGH` or `lognormal:MEDIAN:SIGMA`
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import threading
+from urllib.parse import parse_qs
+
+from aiohttp import web
+
+# the separator ChatGPTAPI.translate_list puts between paragraphs
+BATCH_SEP = "\n\n\n\n\n"
+
+
+def latency_sampler(spec):
+    """a function returning a random latency in seconds, see the module doc"""
+    kind, *args = spec.split(":")
+    args = [float(arg) for arg in args]
+    if kind == "fixed":
+        return lambda: args[0]
+    if kind == "uniform":
+        return lambda: random.uniform(args[0], args[1])
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(math.log(args[0]), args[1])
+    raise ValueError(f"unknown latency {spec}")
+
+
+def count_tokens(text):
+    # about four characters a token, like the tokenizer on english text
+    return len(text) // 4 + 1
+
+
+def fake_translation(text):
+    return "".join(f"[{line}]" if line.strip() else line for line in text.split("\n"))
+
+
+def prompt_text(prompt):
+    """the text to translate of a prompt, between the backticks of the
+    templates of the translators"""
+    if prompt.count("`") >= 2:
+        return prompt.split("`", 1)[1].rsplit("`", 1)[0]
+    return prompt
+
+
+class MockServer:
+    def __init__(
+        self,
+        latency="fixed:0",
+        error_rate=0.0,
+        error_status=(429, 500),
+        retry_after=0.05,
+        seed=None,
+    ):
+        self.latency = latency_sampler(latency)
+        self.error_rate = error_rate
+        self.error_status = list(error_status)
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.stats = {
+            "requests": 0,
+            "errors": 0,
+            "segments": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+        }
+        self.app = web.Application()
+        self.app.router.add_post("/v1/chat/completions", self.chat)
+        self.app.router.add_post("/v1/completions", self.completions)
+        self.app.router.add_post("/translate_a/single", self.google)
+        self.app.router.add_get("/stats", self.get_stats)
+        self.loop = None
+        self.runner = None
+        self.port = None
+
+    async def _begin(self):
+        """wait like the API would, return an error response to inject or
+        None"""
+        self.stats["requests"] += 1
+        await asyncio.sleep(self.latency())
+        if self.random.random() < self.error_rate:
+            self.stats["errors"] += 1
+            status = self.random.choice(self.error_status)
+            return web.json_response(
+                {"error": {"message": "injected error", "type": "mock", "code": None}},
+                status=status,
+                headers={"Retry-After": str(self.retry_after)},
+            )
+        return None
+
+    def _count(self, prompt, completion, segments=1):
+        prompt_tokens = count_tokens(prompt)
+        completion_tokens = count_tokens(completion)
+        self.stats["segments"] += segments
+        self.stats["prompt_tokens"] += prompt_tokens
+        self.stats["completion_tokens"] += completion_tokens
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    async def chat(self, request):
+        body = await request.json()
+        error = await self._begin()
+        if error is not None:
+            return error
+        prompt = "".join(m["content"] for m in body["messages"])
+        text = prompt_text(body["messages"][-1]["content"])
+        paragraphs = text.split(BATCH_SEP)
+        content = "\n".join(fake_translation(p) for p in paragraphs)
+        usage = self._count(prompt, content, len(paragraphs))
+        if not body.get("stream"):
+            return web.json_response(
+                {
+                    "object": "chat.completion",
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": content},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": usage,
+                }
+            )
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        deltas = [{"role": "assistant"}] + [
+            {"content": content[i : i + 4]} for i in range(0, len(content), 4)
+        ]
+        for i, delta in enumerate(deltas + [{}]):
+            chunk = {
+                "object": "chat.completion.chunk",
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": delta,
+                        "finish_reason": "stop" if i == len(deltas) else None,
+                    }
+                ],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def completions(self, request):
+        body = await request.json()
+        error = await self._begin()
+        if error is not None:
+            return error
+        prompts = body["prompt"]
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        choices = []
+        for i, prompt in enumerate(prompts):
+            text = fake_translation(prompt_text(prompt))
+            choices.append({"index": i, "text": text, "finish_reason": "stop"})
+        usage = self._count(
+            "".join(prompts), "".join(c["text"] for c in choices), len(prompts)
+        )
+        return web.json_response({"choices": choices, "usage": usage})
+
+    async def google(self, request):
+        form = parse_qs(await request.text())
+        error = await self._begin()
+        if error is not None:
+            return error
+        text = form.get("q", [""])[0]
+        lines = text.split("\n")
+        sentences = []
+        for i, line in enumerate(lines):
+            end = "\n" if i < len(lines) - 1 else ""
+            sentences.append(
+                {"orig": line + end, "trans": fake_translation(line) + end}
+            )
+        self._count(text, "".join(s["trans"] for s in sentences), len(lines))
+        return web.json_response({"sentences": sentences, "src": "en"})
+
+    async def get_stats(self, request):
+        return web.json_response(self.stats)
+
+    async def _start(self, host, port):
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        self.port = self.runner.addresses[0][1]
+
+    def start(self, host="127.0.0.1", port=0):
+        """serve from a background thread, return the base url"""
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._start(host, port), self.loop).result()
+        return f"http://{host}:{self.port}"
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def add_server_arguments(parser):
+    parser.add_argument("--latency", default="uniform:0.01:0.05")
+    parser.add_argument("--error-rate", dest="error_rate", type=float, default=0.0)
+    parser.add_argument("--error-status", dest="error_status", default="429,500")
+    parser.add_argument("--retry-after", dest="retry_after", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=1)
+
+
+def server_from_options(options):
+    return MockServer(
+        latency=options.latency,
+        error_rate=options.error_rate,
+        error_status=[int(s) for s in options.error_status.split(",") if s],
+        retry_after=options.retry_after,
+        seed=options.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    add_server_arguments(parser)
+    options = parser.parse_args()
+    server = server_from_options(options)
+    base = server.start(options.host, options.port)
+    print(f"serving on {base}, chatgptapi --api_base {base}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
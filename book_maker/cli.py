@@ -1,11 +1,17 @@
 import argparse
+import logging
 import os
 from os import environ as env
 
-from book_maker.loader import BOOK_LOADER_DICT
+from bs4.builder import builder_registry
+
+from book_maker.loader import BOOK_LOADER_DICT, PARSERS
+from book_maker.log import LOG_LEVELS, setup_logging
+from book_maker.metrics import metrics
 from book_maker.translator import MODEL_DICT
 from book_maker.utils import LANGUAGES, TO_LANGUAGE_CODE
-import book_maker.obok as obok
+
+logger = logging.getLogger(__name__)
 
 
 def main():
@@ -14,7 +20,7 @@ def main():
         "--book_name",
         dest="book_name",
         type=str,
-        help="path of the epub file to be translated",
+        help="path of the epub, txt or srt file to be translated",
     )
     parser.add_argument(
         "--book_from",
@@ -57,9 +63,10 @@ def main():
         dest="model",
         type=str,
         default="chatgptapi",
-        choices=["chatgptapi", "gpt3", "google"],  # support DeepL later
         metavar="MODEL",
-        help="model to use, available: {%(choices)s}",
+        # plugins are only looked for when the model is not built in
+        help="model to use, available: {%s} and the installed plugins"
+        % ", ".join(MODEL_DICT.builtin_names()),
     )
     parser.add_argument(
         "--language",
@@ -110,17 +117,173 @@ def main():
         dest="accumulated_num",
         type=int,
         default=1,
-        help="Wait for how many characters have been accumulated before starting the translation",
+        help="Wait for how many tokens have been accumulated before starting the translation",
+    )
+    parser.add_argument(
+        "--accumulated_output_num",
+        dest="accumulated_output_num",
+        type=int,
+        default=2048,
+        help="how many tokens the translation of an accumulated batch may be expected to have",
+    )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=1,
+        help="how many translation requests to keep in flight at the same time",
+    )
+    parser.add_argument(
+        "--parse_workers",
+        dest="parse_workers",
+        type=int,
+        default=0,
+        help="how many processes parse and write the chapters of an epub while it is translated",
+    )
+    parser.add_argument(
+        "--parser",
+        dest="parser",
+        type=str,
+        default="html.parser",
+        choices=PARSERS,
+        help="BeautifulSoup backend used to parse the epub, lxml is the fastest",
+    )
+    parser.add_argument(
+        "--rpm",
+        dest="rpm",
+        type=str,
+        default="",
+        help="requests per minute allowed for each key, one value for all keys or"
+        " comma separated values in the same order as --openai_key",
+    )
+    parser.add_argument(
+        "--tpm",
+        dest="tpm",
+        type=str,
+        default="",
+        help="tokens per minute allowed for each key, one value for all keys or"
+        " comma separated values in the same order as --openai_key",
+    )
+    parser.add_argument(
+        "--max_retries",
+        dest="max_retries",
+        type=int,
+        default=6,
+        help="how many times a failed request is retried, with growing waits in between",
+    )
+    parser.add_argument(
+        "--request_deadline",
+        dest="request_deadline",
+        type=int,
+        default=600,
+        help="seconds a request may take over all its retries before the run stops",
+    )
+    parser.add_argument(
+        "--request_timeout",
+        dest="request_timeout",
+        type=int,
+        default=120,
+        help="seconds a single request may take",
+    )
+    parser.add_argument(
+        "--max_connections",
+        dest="max_connections",
+        type=int,
+        default=64,
+        help="how many connections to the translation API are kept open with --workers",
+    )
+    parser.add_argument(
+        "--stream",
+        dest="stream",
+        action="store_true",
+        help="stream the chatgptapi completions, the paragraphs of a batch are"
+        " saved as they arrive and runaway outputs are stopped early",
+    )
+    parser.add_argument(
+        "--log-level",
+        dest="log_level",
+        type=str,
+        default="info",
+        choices=LOG_LEVELS,
+        help="debug also logs the text and translation of every paragraph",
+    )
+    parser.add_argument(
+        "--quiet",
+        dest="quiet",
+        action="store_true",
+        help="only log warnings and errors, same as --log-level warning",
+    )
+    parser.add_argument(
+        "--log_file",
+        dest="log_file",
+        type=str,
+        default="",
+        help="also write the log to this file",
+    )
+    parser.add_argument(
+        "--metrics_json",
+        dest="metrics_json",
+        type=str,
+        default="",
+        help="write a JSON summary of the run to this file: request latencies,"
+        " retries, tokens per key, cache hits and time spent by stage",
+    )
+    parser.add_argument(
+        "--metrics_textfile",
+        dest="metrics_textfile",
+        type=str,
+        default="",
+        help="keep the metrics in this Prometheus textfile during the run,"
+        " e.g. for the textfile collector of node_exporter",
+    )
+    parser.add_argument(
+        "--metrics_interval",
+        dest="metrics_interval",
+        type=int,
+        default=15,
+        help="seconds between the updates of --metrics_textfile",
+    )
+    parser.add_argument(
+        "--use_cache",
+        dest="use_cache",
+        action="store_true",
+        help="keep translations in a local cache shared by all runs and books,"
+        " cached paragraphs are not sent again",
+    )
+    parser.add_argument(
+        "--cache_path",
+        dest="cache_path",
+        type=str,
+        default="~/.cache/bilingual_book_maker/translations.sqlite3",
+        help="path of the translation cache file",
+    )
+    parser.add_argument(
+        "--cache_size",
+        dest="cache_size",
+        type=int,
+        default=100000,
+        help="how many translations the cache keeps before dropping the least recently used",
     )
 
     options = parser.parse_args()
+    log_listener = setup_logging(
+        "warning" if options.quiet else options.log_level, options.log_file
+    )
     PROXY = options.proxy
     if PROXY != "":
         os.environ["http_proxy"] = PROXY
         os.environ["https_proxy"] = PROXY
 
-    translate_model = MODEL_DICT.get(options.model)
-    assert translate_model is not None, "unsupported model"
+    if options.model not in MODEL_DICT:
+        parser.error(
+            f"unsupported model {options.model}, available: {', '.join(MODEL_DICT)}"
+        )
+    translate_model = MODEL_DICT[options.model]
+    # lxml and html5lib are not installed with bs4
+    if builder_registry.lookup(options.parser) is None:
+        parser.error(
+            f"the {options.parser} parser is not installed, pip install {options.parser}"
+        )
     if options.model in ["gpt3", "chatgptapi"]:
         OPENAI_API_KEY = options.openai_key or env.get("OPENAI_API_KEY")
         if not OPENAI_API_KEY:
@@ -136,17 +299,18 @@ def main():
             raise Exception(
                 "Device path is not given, please specify the path by --device_path <DEVICE_PATH>"
             )
+        # obok looks for libcrypto when it is imported
+        import book_maker.obok as obok
+
         options.book_name = obok.cli_main(device_path)
 
     book_type = options.book_name.split(".")[-1]
-    support_type_list = list(BOOK_LOADER_DICT.keys())
-    if book_type not in support_type_list:
+    if book_type not in BOOK_LOADER_DICT:
         raise Exception(
-            f"now only support files of these formats: {','.join(support_type_list)}"
+            f"now only support files of these formats: {','.join(BOOK_LOADER_DICT)}"
         )
 
-    book_loader = BOOK_LOADER_DICT.get(book_type)
-    assert book_loader is not None, "unsupported loader"
+    book_loader = BOOK_LOADER_DICT[book_type]
     language = options.language
     if options.language in LANGUAGES:
         # use the value for prompt
@@ -167,8 +331,44 @@ def main():
         translate_tags=options.translate_tags,
         allow_navigable_strings=options.allow_navigable_strings,
         accumulated_num=options.accumulated_num,
+        accumulated_output_num=options.accumulated_output_num,
+        workers=options.workers,
     )
-    e.make_bilingual_book()
+    if options.rpm or options.tpm:
+        e.translate_model.set_rate_limits(
+            rpm=[int(i) for i in options.rpm.split(",") if i],
+            tpm=[int(i) for i in options.tpm.split(",") if i],
+        )
+    e.parse_workers = options.parse_workers
+    e.parser = options.parser
+    e.translate_model.max_retries = options.max_retries
+    e.translate_model.deadline = options.request_deadline
+    e.translate_model.timeout = options.request_timeout
+    e.translate_model.max_connections = options.max_connections
+    if options.stream and options.model == "chatgptapi":
+        e.translate_model.stream = True
+    cache = None
+    if options.use_cache:
+        from book_maker.translator.cache import CachedTranslator, TranslationCache
+
+        cache = TranslationCache(options.cache_path, options.cache_size)
+        e.translate_model = CachedTranslator(e.translate_model, cache)
+    if options.metrics_textfile:
+        metrics.start_textfile(options.metrics_textfile, options.metrics_interval)
+    try:
+        e.make_bilingual_book()
+    finally:
+        if cache is not None:
+            logger.info(
+                "translation cache: %d hits, %d misses", cache.hits, cache.misses
+            )
+            cache.close()
+        if options.metrics_textfile:
+            metrics.stop_textfile()
+            metrics.write_textfile(options.metrics_textfile)
+        if options.metrics_json:
+            metrics.write_json(options.metrics_json)
+        log_listener.stop()
 
 
 if __name__ == "__main__":
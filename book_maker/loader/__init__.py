@@ -1,9 +1,16 @@
-from book_maker.loader.epub_loader import EPUBBookLoader
+from book_maker.plugins import LazyRegistry
 
-from book_maker.loader.txt_loader import TXTBookLoader
+# BeautifulSoup backends of the epub loader, lxml is the fastest, html5lib the
+# most lenient
+PARSERS = ("html.parser", "lxml", "html5lib")
 
-BOOK_LOADER_DICT = {
-    "epub": EPUBBookLoader,
-    "txt": TXTBookLoader
-    # TODO add more here
-}
+# the loaders are only imported when a book of their type is loaded
+BOOK_LOADER_DICT = LazyRegistry(
+    "bilingual_book_maker.loaders",
+    {
+        "epub": "book_maker.loader.epub_loader:EPUBBookLoader",
+        "txt": "book_maker.loader.txt_loader:TXTBookLoader",
+        "srt": "book_maker.loader.srt_loader:SRTBookLoader",
+        # TODO add more here
+    },
+)
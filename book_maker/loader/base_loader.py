@@ -1,11 +1,222 @@
+import asyncio
+import logging
+import threading
 from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+logger = logging.getLogger(__name__)
+
+
+class EventLoopThread:
+    """
+    an event loop running in a daemon thread, the requests of an async
+    translator are all run on it and share its connections
+    """
+
+    def __init__(self, limit=1):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        # made on the loop, a semaphore belongs to the loop it is made on
+        self.semaphore = self.submit(self._semaphore(limit)).result()
+
+    @staticmethod
+    async def _semaphore(limit):
+        return asyncio.Semaphore(limit)
+
+    def submit(self, coro):
+        """run `coro` on the loop, return a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def submit_limited(self, func, *args):
+        """run `func(*args)` on the loop, at most `limit` of them at a time"""
+        return self.submit(self._limited(func, *args))
+
+    async def _limited(self, func, *args):
+        async with self.semaphore:
+            return await func(*args)
+
+    def close(self, translator=None):
+        """close the connections of `translator`, then stop the loop"""
+        if translator is not None:
+            try:
+                self.submit(translator.aclose()).result()
+            except Exception:
+                pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
 
 
 class BaseBookLoader(ABC):
+    workers = 1
+
     @staticmethod
     def _is_special_text(text):
         return text.isdigit() or text.isspace()
 
+    def _translate_in_order(self, jobs, on_segment=None, on_drop=None):
+        """Translate ``(payload, text)`` jobs and yield ``(payload, result)``.
+
+        Results come back in the order of the jobs while up to ``self.workers``
+        requests are in flight. A list of paragraphs as text is sent with
+        ``translate_list``. Jobs whose text is None are passed through with a
+        None result and no request.
+
+        The requests of an async translator run as coroutines on one event
+        loop instead of in a thread each.
+
+        When the translator streams, ``on_segment(payload, number, text)`` is
+        called with every paragraph of a list as soon as it arrives, from the
+        thread doing the request. They are not checked yet: when the answer
+        turns out to have another number of lines, ``on_drop(payload)`` is
+        called before the list is sent again in parts.
+        """
+
+        def segments(payload, text):
+            if on_segment is None or not isinstance(text, list):
+                return None
+            if not getattr(self.translate_model, "stream", False):
+                return None
+            drop = (lambda: None) if on_drop is None else partial(on_drop, payload)
+            return partial(on_segment, payload), drop
+
+        if self.workers <= 1:
+            for payload, text in jobs:
+                if text is None:
+                    yield payload, None
+                else:
+                    yield payload, self._translate(text, segments(payload, text))
+            return
+
+        # keep some requests queued behind the running ones, so one slow
+        # response at the head does not leave the other workers idle
+        window = self.workers * 2
+        pending = deque()
+        in_flight = 0
+        if getattr(self.translate_model, "is_async", False):
+            # the window only queues, no more than `workers` requests run
+            runner = EventLoopThread(self.workers)
+            submit = lambda text, segments: runner.submit_limited(
+                self._atranslate, text, segments
+            )
+        else:
+            runner = ThreadPoolExecutor(max_workers=self.workers)
+            submit = lambda text, segments: runner.submit(
+                self._translate, text, segments
+            )
+        try:
+            for payload, text in jobs:
+                if text is None:
+                    pending.append((payload, None))
+                else:
+                    future = submit(text, segments(payload, text))
+                    pending.append((payload, future))
+                    in_flight += 1
+                while pending and (pending[0][1] is None or in_flight >= window):
+                    payload, future = pending.popleft()
+                    if future is None:
+                        yield payload, None
+                    else:
+                        in_flight -= 1
+                        yield payload, future.result()
+            while pending:
+                payload, future = pending.popleft()
+                yield payload, None if future is None else future.result()
+        finally:
+            for _, future in pending:
+                if future is not None:
+                    future.cancel()
+            if isinstance(runner, EventLoopThread):
+                runner.close(self.translate_model)
+            else:
+                runner.shutdown(wait=False)
+
+    def _translate(self, text, segments=None):
+        if isinstance(text, list):
+            return self._translate_batch(text, segments)
+        return self.translate_model.translate(text)
+
+    async def _atranslate(self, text, segments=None):
+        if isinstance(text, list):
+            return await self._atranslate_batch(text, segments)
+        return await self.translate_model.atranslate(text)
+
+    def _translate_batch(self, texts, segments=None):
+        """the translations of `texts`, one for each. A batch answered with
+        another number of lines can not be matched with its paragraphs, it is
+        split in halves until every part is, a single paragraph is sent on
+        its own. `segments` are the ``(on_segment, on_drop)`` callbacks of a
+        streamed batch, the parts are not streamed."""
+        if len(texts) == 1:
+            return [self.translate_model.translate(texts[0])]
+        if segments is None:
+            t_list = self.translate_model.translate_list(texts)
+        else:
+            t_list = self.translate_model.translate_list(texts, on_segment=segments[0])
+        if len(t_list) == len(texts):
+            return t_list
+        if segments is not None:
+            segments[1]()
+        logger.warning(
+            "%d lines for a batch of %d paragraphs, sending it in halves",
+            len(t_list),
+            len(texts),
+        )
+        half = len(texts) // 2
+        return self._translate_batch(texts[:half]) + self._translate_batch(texts[half:])
+
+    async def _atranslate_batch(self, texts, segments=None):
+        if len(texts) == 1:
+            return [await self.translate_model.atranslate(texts[0])]
+        if segments is None:
+            t_list = await self.translate_model.atranslate_list(texts)
+        else:
+            t_list = await self.translate_model.atranslate_list(
+                texts, on_segment=segments[0]
+            )
+        if len(t_list) == len(texts):
+            return t_list
+        if segments is not None:
+            segments[1]()
+        logger.warning(
+            "%d lines for a batch of %d paragraphs, sending it in halves",
+            len(t_list),
+            len(texts),
+        )
+        half = len(texts) // 2
+        return await self._atranslate_batch(
+            texts[:half]
+        ) + await self._atranslate_batch(texts[half:])
+
+    def _pack_batches(self, items):
+        """Pack ``(key, text)`` items in order into batches under both token
+        budgets, yield every batch as a list of items.
+
+        A batch holds at most ``accumulated_num`` tokens of source text and is
+        expected to come back with at most ``accumulated_output_num`` tokens.
+        A paragraph over either budget is sent on its own.
+        """
+        batch = []
+        input_tokens = output_tokens = 0
+        for key, text in items:
+            p_input = self.translate_model.count_tokens(text)
+            p_output = self.translate_model.expected_output_tokens(text)
+            if batch and (
+                input_tokens + p_input > self.accumulated_num
+                or output_tokens + p_output > self.accumulated_output_num
+            ):
+                yield batch
+                batch = []
+                input_tokens = output_tokens = 0
+            batch.append((key, text))
+            input_tokens += p_input
+            output_tokens += p_output
+        if batch:
+            yield batch
+
     @abstractmethod
     def _make_new_book(self, book):
         pass
@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from book_maker.metrics import metrics
+from book_maker.utils import normalize_text
+
+
+def text_hash(text):
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()[:16]
+
+
+class CheckpointJournal:
+    """
+    append-only JSON lines journal of the finished translations
+
+    Every record names the document (`href`), the position of the segment in
+    it (`index`), the `hash` of its source text and the translated `text`.
+    Translations are found again by document and hash, so they still match
+    when the segments are cut differently on resume.
+    Segments of a batch streamed before the whole answer is checked are
+    provisional, they carry the id of their `batch`. A `{"drop": batch}`
+    record discards them, a later record of the same segment replaces them.
+    Appending costs the same whatever the size of the book: records are
+    buffered and written with an fsync every `flush_interval` seconds. A crash
+    can only cut the last line, which is skipped when the journal is loaded.
+    """
+
+    def __init__(self, path, flush_interval=5):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.file = None
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+
+    def load(self):
+        records = []
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # a line cut by a crash
+                    continue
+        return records
+
+    def records(self):
+        """the records of the translations, without the dropped ones"""
+        records = self.load()
+        dropped = {r["drop"] for r in records if "drop" in r}
+        return [r for r in records if "drop" not in r and r.get("batch") not in dropped]
+
+    def translations(self):
+        """the saved translations by (href, hash)"""
+        return {(r["href"], r["hash"]): r["text"] for r in self.records()}
+
+    def open(self, append=False):
+        self.file = open(self.path, "a" if append else "w", encoding="utf-8")
+
+    def append(self, href, index, source, text, batch=None):
+        record = {"href": href, "index": index, "hash": text_hash(source), "text": text}
+        if batch is not None:
+            record["batch"] = batch
+        self._write(record)
+
+    def drop(self, batch):
+        """discard the provisional records of `batch`"""
+        self._write({"drop": batch})
+
+    def _write(self, record):
+        with self.lock:
+            self.buffer.append(json.dumps(record, ensure_ascii=False) + "\n")
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.file is None:
+                return
+            if self.buffer:
+                with metrics.timer("checkpoint"):
+                    self.file.write("".join(self.buffer))
+                    self.buffer = []
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+            self.last_flush = time.monotonic()
+
+    def compact(self):
+        """rewrite the journal with one record per segment, the last one wins"""
+        self.close()
+        with metrics.timer("checkpoint"):
+            records = {}
+            for record in self.records():
+                records[(record["href"], record["hash"])] = record
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                for record in records.values():
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class OffsetCheckpoint:
+    """
+    how far a book read as a stream got: the byte offsets reached in the book
+    and in its output, kept in a small JSON file that is replaced atomically.
+    Resuming seeks straight there, whatever the size of the book.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """the saved state, None when there is none"""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, state):
+        with metrics.timer("checkpoint"):
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,284 @@
+import codecs
+import re
+import warnings
+from collections import deque
+
+from bs4 import BeautifulSoup as bs
+from bs4 import NavigableString, SoupStrainer, Tag, UnicodeDammit
+from bs4 import element as bs4_element
+
+try:
+    from bs4 import XMLParsedAsHTMLWarning
+
+    # the XHTML documents are parsed as HTML on purpose
+    warnings.filterwarnings("ignore", category=XMLParsedAsHTMLWarning)
+except ImportError:
+    pass
+
+# the functions only take and return plain data, so they can run in a
+# process pool as well as in the main process
+
+
+def is_special_text(text):
+    return text.isdigit() or text.isspace()
+
+
+def parse_chapter(
+    content,
+    trans_taglist,
+    allow_navigable_strings=False,
+    parser="html.parser",
+    selective=False,
+):
+    """
+    parse a document, return the soup and the elements to translate
+
+    With `selective` only the elements to translate are built, which is
+    enough to read their texts but not to render the document.
+    """
+    if parser == "html.parser":
+        # parse the same text the translations are spliced into
+        content = decode_markup(content)
+    parse_only = None
+    # html5lib always builds the whole tree
+    if selective and not allow_navigable_strings and parser != "html5lib":
+        parse_only = SoupStrainer(trans_taglist)
+    soup = bs(content, parser, parse_only=parse_only)
+    p_list = soup.findAll(trans_taglist)
+    if allow_navigable_strings:
+        p_list.extend(soup.findAll(text=True))
+    p_list = [p for p in p_list if p.text and not is_special_text(p.text)]
+    return soup, p_list
+
+
+def extract_texts(
+    content, trans_taglist, allow_navigable_strings=False, parser="html.parser"
+):
+    """the texts to translate of a document, in order"""
+    _, p_list = parse_chapter(
+        content, trans_taglist, allow_navigable_strings, parser, selective=True
+    )
+    return [p.text for p in p_list]
+
+
+def translated_copy(p, t_text):
+    """a copy of the element `p` holding only `t_text`"""
+    if isinstance(p, NavigableString):
+        return NavigableString(t_text)
+    # the children of `p` are not copied, they would be replaced anyway
+    new_p = Tag(
+        name=p.name,
+        namespace=p.namespace,
+        prefix=p.prefix,
+        attrs=p.attrs,
+        is_xml=p._is_xml,
+    )
+    new_p.string = t_text
+    return new_p
+
+
+def insert_translation(p, t_text):
+    p.insert_after(translated_copy(p, t_text))
+
+
+def decode_markup(content):
+    if isinstance(content, str):
+        return content
+    return UnicodeDammit(content, is_html=True).unicode_markup
+
+
+_declared_encoding = re.compile(
+    r"""<\?xml[^>]*?\sencoding\s*=\s*["']([\w.:-]+)"""
+    r"""|<meta[^>]*?charset\s*=\s*["']?([\w.:-]+)""",
+    re.I,
+)
+
+
+def encode_markup(text):
+    """`text` in the encoding declared by its xml declaration or <meta>, so
+    the declaration stays true, in UTF-8 when it declares none"""
+    encoding = "utf-8"
+    m = _declared_encoding.search(text, 0, 4096)
+    if m:
+        try:
+            encoding = codecs.lookup(m.group(1) or m.group(2)).name
+        except LookupError:
+            pass
+    # a translation can hold characters the encoding does not have
+    return text.encode(encoding, "xmlcharrefreplace")
+
+
+# strings whose markup is not parsed for tags: comments, CDATA sections,
+# declarations, scripts and styles
+_RAW_STRINGS = tuple(
+    getattr(bs4_element, name)
+    for name in ("PreformattedString", "Script", "Stylesheet", "TemplateString")
+    if hasattr(bs4_element, name)
+)
+
+_end_tag_patterns = {}
+
+
+def _end_tag_pattern(name):
+    if name not in _end_tag_patterns:
+        _end_tag_patterns[name] = re.compile(f"</{re.escape(name)}\\s*>", re.I)
+    return _end_tag_patterns[name]
+
+
+def _is_plain(node):
+    """whether the end tag of an element can be looked for in the markup of
+    `node`: a comment, a CDATA section, a script or a "<" in an attribute
+    could hold something that looks like it"""
+    if isinstance(node, Tag):
+        return node.name not in ("script", "style") and all(
+            "<" not in str(value) for value in node.attrs.values()
+        )
+    return not isinstance(node, _RAW_STRINGS)
+
+
+class Markup:
+    """the text of a document and where its lines start, to turn the
+    positions BeautifulSoup gives to the elements into offsets"""
+
+    def __init__(self, text):
+        self.text = text
+        self.line_starts = [0] + [m.end() for m in re.finditer("\n", text)]
+
+    def start_of(self, p):
+        if p.sourceline is None:
+            return None
+        return self.line_starts[p.sourceline - 1] + p.sourcepos
+
+    def end_of(self, p):
+        """
+        the offset after the end tag of the element `p`, None when it was
+        closed without one or it can not be told apart
+
+        The end tag is between the start of `p` and the start of the element
+        after it, both recorded by the parser. It is the last of the end tags
+        of that name there, when there is one for `p` and for each element of
+        the same name in it, and the markup in between is plain text and tags.
+        """
+        start = self.start_of(p)
+        if start is None or not _is_plain(p):
+            return None
+        same_name = 1
+        last = p
+        for node in p.descendants:
+            if not _is_plain(node):
+                return None
+            if isinstance(node, Tag) and node.name == p.name:
+                same_name += 1
+            last = node
+        bound = len(self.text)
+        for node in last.next_elements:
+            if isinstance(node, Tag):
+                bound = self.start_of(node)
+                break
+            if not _is_plain(node):
+                return None
+        if bound is None:
+            return None
+        end_tags = list(_end_tag_pattern(p.name).finditer(self.text, start, bound))
+        # an element closed without its end tag leaves them uneven
+        if len(end_tags) != same_name:
+            return None
+        return end_tags[-1].end()
+
+
+def splice_translations(markup, p_list, translations):
+    """
+    the markup with every translation inserted right after the end tag of
+    its element, the rest of the document is kept as it is
+
+    None when an element can not be found in the markup, e.g. a navigable
+    string or an element without an end tag.
+    """
+    markup = Markup(markup)
+    inserts = []
+    for i in sorted(translations):
+        p = p_list[i]
+        if isinstance(p, NavigableString):
+            return None
+        end = markup.end_of(p)
+        if end is None:
+            return None
+        inserts.append((end, str(translated_copy(p, translations[i]))))
+    inserts.sort(key=lambda insert: insert[0])
+    pieces = []
+    last = 0
+    for end, html in inserts:
+        pieces.append(markup.text[last:end])
+        pieces.append(html)
+        last = end
+    pieces.append(markup.text[last:])
+    return "".join(pieces)
+
+
+def match_translations(p_list, texts, translations):
+    """
+    `translations` of `texts` moved to the indices of the elements of
+    `p_list` with the same texts, in order
+
+    A selective parse can find other elements than the full one, e.g. around
+    an element without its end tag. The translations of texts the full parse
+    does not have are left out.
+    """
+    full_texts = [p.text for p in p_list]
+    if full_texts == texts:
+        return translations
+    by_text = {}
+    for i in sorted(translations):
+        by_text.setdefault(texts[i], deque()).append(translations[i])
+    matched = {}
+    for i, text in enumerate(full_texts):
+        queue = by_text.get(text)
+        if queue:
+            matched[i] = queue.popleft()
+    return matched
+
+
+def render_chapter(
+    content,
+    trans_taglist,
+    allow_navigable_strings,
+    translations,
+    parsed=None,
+    parser="html.parser",
+    texts=None,
+):
+    """
+    the document with every translation of `translations` ({index of the
+    text: translation}) inserted after its element
+
+    `parsed` is the result of `parse_chapter` when it is still at hand, the
+    document is parsed again otherwise. `texts` are the texts the indices
+    refer to when they were not read from `parsed`, e.g. by `extract_texts`,
+    the translations are matched with the elements by their texts when the
+    two parses differ. With html.parser the translations are spliced into
+    the original markup, which is kept as it is, otherwise or when that
+    fails the whole tree is serialized.
+    """
+    if parsed is None:
+        parsed = parse_chapter(content, trans_taglist, allow_navigable_strings, parser)
+    soup, p_list = parsed
+    if texts is not None:
+        translations = match_translations(p_list, texts, translations)
+    if parser == "html.parser":
+        markup = splice_translations(decode_markup(content), p_list, translations)
+        if markup is not None:
+            return encode_markup(markup)
+    for i in sorted(translations):
+        insert_translation(p_list[i], translations[i])
+    return encode_markup(str(soup))
+
+
+class Chapter:
+    """a document of the book with its texts to translate and the
+    translations received so far"""
+
+    def __init__(self, item, texts, parsed=None):
+        self.item = item
+        self.texts = texts
+        self.parsed = parsed
+        self.translations = {}
@@ -1,18 +1,39 @@
+import logging
 import os
-import pickle
 import sys
-from copy import copy
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
 
-from bs4 import BeautifulSoup as bs
 from ebooklib import ITEM_DOCUMENT, epub
-from rich import print
 from tqdm import tqdm
 
+from book_maker.metrics import metrics
+from book_maker.utils import normalize_text
+
 from .base_loader import BaseBookLoader
+from .checkpoint import CheckpointJournal, text_hash
+from .epub_chapter import Chapter, extract_texts, parse_chapter, render_chapter
+from .epub_stream import StreamingEpubWriter, read_epub
+
+logger = logging.getLogger(__name__)
 
 
 class EPUBBookLoader(BaseBookLoader):
+    # bytes of memory the parsed trees kept from the first pass over the book
+    # to the translation may take, so they are not parsed twice
+    parse_cache_size = 256 * 1024 * 1024
+    # a parsed tree takes about this many times the size of its XHTML, 7 to 8
+    # for the books in test_books with either parser
+    tree_size_factor = 10
+    # processes parsing and rendering the chapters while the translation runs,
+    # with 1 or less it is done in the main process
+    parse_workers = 0
+    # BeautifulSoup backend, one of book_maker.loader.PARSERS
+    parser = "html.parser"
+
     def __init__(
         self,
         epub_name,
@@ -26,6 +47,8 @@ class EPUBBookLoader(BaseBookLoader):
         translate_tags="p",
         allow_navigable_strings=False,
         accumulated_num=1,
+        accumulated_output_num=2048,
+        workers=1,
     ):
         self.epub_name = epub_name
         self.new_epub = epub.EpubBook()
@@ -35,9 +58,11 @@ class EPUBBookLoader(BaseBookLoader):
         self.translate_tags = translate_tags
         self.allow_navigable_strings = allow_navigable_strings
         self.accumulated_num = accumulated_num
+        self.accumulated_output_num = accumulated_output_num
+        self.workers = workers
 
         try:
-            self.origin_book = epub.read_epub(self.epub_name)
+            self.origin_book = read_epub(self.epub_name)
         except Exception:
             # tricky for #71 if you don't know why please check the issue and ignore this
             # when upstream change will TODO fix this
@@ -52,11 +77,14 @@ class EPUBBookLoader(BaseBookLoader):
                 self.book.set_direction(spine.get("page-progression-direction", None))
 
             epub.EpubReader._load_spine = _load_spine
-            self.origin_book = epub.read_epub(self.epub_name)
+            self.origin_book = read_epub(self.epub_name)
 
-        self.p_to_save = []
+        # saved translations by (href, hash of the source text)
+        self.resumed = {}
         self.resume = resume
-        self.bin_path = f"{Path(epub_name).parent}/.{Path(epub_name).stem}.temp.bin"
+        self.journal = CheckpointJournal(
+            f"{Path(epub_name).parent}/.{Path(epub_name).stem}.temp.jsonl"
+        )
         if self.resume:
             self.load_state()
 
@@ -72,161 +100,376 @@ class EPUBBookLoader(BaseBookLoader):
         return new_book
 
     def make_bilingual_book(self):
-        def deal_new(p, waitPList):
-            ret = deal_old(waitPList)
-            new_p = copy(p)
-            new_p.string = self.translate_model.translate(p.text)
-            p.insert_after(new_p)
-            return ret
-
-        def deal_old(waitPList):
-            if len(waitPList) == 0:
-                return []
-
-            resultTxtList = self.translate_model.translate_list(waitPList)
-
-            for i in range(0, len(waitPList)):
-                if i < len(resultTxtList):
-                    p = waitPList[i]
-                    new_p = copy(p)
-                    new_p.string = resultTxtList[i]
-                    p.insert_after(new_p)
-
-            return []
-
         new_book = self._make_new_book(self.origin_book)
-        all_items = list(self.origin_book.get_items())
-        trans_taglist = self.translate_tags.split(",")
-        all_p_length = sum(
-            0
-            if i.get_type() != ITEM_DOCUMENT
-            else len(bs(i.content, "html.parser").findAll(trans_taglist))
-            for i in all_items
-        )
-        all_p_length += self.allow_navigable_strings * sum(
-            0
-            if i.get_type() != ITEM_DOCUMENT
-            else len(bs(i.content, "html.parser").findAll(text=True))
-            for i in all_items
-        )
+        self.trans_taglist = self.translate_tags.split(",")
+        self.pool = None
+        if self.parse_workers > 1:
+            self.pool = ProcessPoolExecutor(max_workers=self.parse_workers)
+        with metrics.timer("parse"):
+            chapters = self._load_chapters()
+        all_p_length, self.repeated = self._scan_paragraphs(chapters)
+        # translations of repeated paragraphs, reused for every later occurrence
+        self.repeated_translations = {}
+        self.dedup_reused = 0
         pbar = tqdm(total=self.test_num) if self.is_test else tqdm(total=all_p_length)
-        index = 0
-        p_to_save_len = len(self.p_to_save)
+        name, _ = os.path.splitext(self.epub_name)
+        writer = StreamingEpubWriter(f"{name}_bilingual.epub", new_book, self.epub_name)
+        writer.open()
+        self.writer = writer
+        # chapters being translated or rendered and not written yet
+        self.in_progress = {}
+        # chapters rendered in the pool, written in book order when done
+        self.rendering = deque()
+        self.journal.open(append=self.resume)
+        # the streamed batches of this run are told apart from those of the
+        # runs before in the journal
+        self.run_id = uuid.uuid4().hex[:8]
         try:
             # Add the things that don't need to be translated first, so that you can see the img after the interruption
             for item in self.origin_book.get_items():
                 if item.get_type() != ITEM_DOCUMENT:
-                    new_book.add_item(item)
-
-            for item in self.origin_book.get_items_of_type(ITEM_DOCUMENT):
-                soup = bs(item.content, "html.parser")
-                p_list = soup.findAll(trans_taglist)
-                if self.allow_navigable_strings:
-                    p_list.extend(soup.findAll(text=True))
-
-                sendNum = self.accumulated_num
-                if sendNum > 1:
-                    count = 0
-                    waitPList = []
-                    for i in range(0, len(p_list)):
-                        p = p_list[i]
-                        if not p.text or self._is_special_text(p.text):
-                            continue
-                        length = len(p.text)
-                        if length > sendNum:
-                            waitPList = deal_new(p, waitPList)
-                            continue
-                        if i == len(p_list) - 1:
-                            if count + length < sendNum:
-                                waitPList.append(p)
-                                waitPList = deal_old(waitPList)
-                            else:
-                                waitPList = deal_new(p, waitPList)
-                            break
-                        if count + length < sendNum:
-                            count += length
-                            waitPList.append(p)
-                        else:
-                            waitPList = deal_old(waitPList)
-                            waitPList.append(p)
-                            count = len(p.text)
-                else:
-                    is_test_done = self.is_test and index > self.test_num
-                    for p in p_list:
-                        if is_test_done or not p.text or self._is_special_text(p.text):
-                            continue
-                        new_p = copy(p)
-                        # TODO banch of p to translate then combine
-                        # PR welcome here
-                        if self.resume and index < p_to_save_len:
-                            new_p.string = self.p_to_save[index]
-                        else:
-                            new_p.string = self.translate_model.translate(p.text)
-                            self.p_to_save.append(new_p.text)
-                        p.insert_after(new_p)
-                        index += 1
-                        if index % 20 == 0:
-                            self._save_progress()
-                        # pbar.update(delta) not pbar.update(index)?
-                        pbar.update(1)
-                        if self.is_test and index >= self.test_num:
-                            break
+                    writer.add_item(item)
 
-                item.content = soup.prettify().encode()
-                new_book.add_item(item)
-            name, _ = os.path.splitext(self.epub_name)
-            epub.write_epub(f"{name}_bilingual.epub", new_book, {})
+            jobs = self._iter_paragraph_jobs(chapters)
+            for (chapter, i, saved), t_text in self._translate_in_order(
+                jobs, on_segment=self._save_segment, on_drop=self._drop_segments
+            ):
+                if i is None:
+                    # end of a chapter, every paragraph of it is translated
+                    self._finish_chapter(chapter)
+                    continue
+                href = chapter.item.file_name
+                if isinstance(i, list):
+                    if len(t_text) != len(i):
+                        # the lines can not be matched with the paragraphs,
+                        # they stay untranslated and are not journaled
+                        logger.error(
+                            "%d translations for %d paragraphs of %s",
+                            len(t_text),
+                            len(i),
+                            href,
+                        )
+                        pbar.update(len(i))
+                        continue
+                    for j, t in zip(i, t_text):
+                        chapter.translations[j] = t
+                        self.journal.append(href, j, chapter.texts[j], t)
+                        self._remember_repeated(chapter.texts[j], t)
+                    metrics.inc("paragraphs_total", len(t_text), source="translated")
+                    pbar.update(len(i))
+                    continue
+                text = chapter.texts[i]
+                source = "translated"
+                if t_text is None and saved is None:
+                    # a repeated paragraph, translated at its first occurrence
+                    t_text = self.repeated_translations.get(normalize_text(text))
+                    if t_text is None:
+                        pbar.update(1)
+                        continue
+                    self.dedup_reused += 1
+                    source = "repeated"
+                if t_text is None:
+                    t_text = saved
+                    source = "resumed"
+                else:
+                    self.journal.append(href, i, text, t_text)
+                metrics.inc("paragraphs_total", source=source)
+                chapter.translations[i] = t_text
+                self._remember_repeated(text, t_text)
+                # pbar.update(delta) not pbar.update(index)?
+                pbar.update(1)
+            with metrics.timer("serialize"):
+                self._write_rendered(wait=True)
+                writer.close()
+            self.journal.compact()
             pbar.close()
+            if self.dedup_reused:
+                logger.info(
+                    "%d repeated paragraphs reused the translation of their first occurrence",
+                    self.dedup_reused,
+                )
         except (KeyboardInterrupt, Exception) as e:
-            print(e)
-            print("you can resume it next time")
+            logger.error("%s", e)
+            logger.error("you can resume it next time")
             self._save_progress()
             self._save_temp_book()
             sys.exit(0)
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown(wait=False)
+
+    def _load_chapters(self):
+        """Extract the texts to translate of every document item.
+
+        With a pool the documents are parsed there in parallel and only their
+        texts come back, they are parsed again there to be rendered. Without
+        it the parsed trees are kept for rendering while their estimated size,
+        ``tree_size_factor`` times their source, fits in ``parse_cache_size``,
+        the others are parsed again. Documents whose
+        tree is not kept are parsed selectively, only the elements to
+        translate are built.
+        """
+        items = list(self.origin_book.get_items_of_type(ITEM_DOCUMENT))
+        if self.pool is not None:
+            all_texts = self.pool.map(
+                extract_texts,
+                [item.content for item in items],
+                repeat(self.trans_taglist),
+                repeat(self.allow_navigable_strings),
+                repeat(self.parser),
+            )
+            return [Chapter(item, texts) for item, texts in zip(items, all_texts)]
+        chapters = []
+        cached_size = 0
+        for item in items:
+            tree_size = len(item.content) * self.tree_size_factor
+            if cached_size + tree_size > self.parse_cache_size:
+                texts = extract_texts(
+                    item.content,
+                    self.trans_taglist,
+                    self.allow_navigable_strings,
+                    self.parser,
+                )
+                chapters.append(Chapter(item, texts))
+                continue
+            cached_size += tree_size
+            parsed = parse_chapter(
+                item.content,
+                self.trans_taglist,
+                self.allow_navigable_strings,
+                self.parser,
+            )
+            chapters.append(Chapter(item, [p.text for p in parsed[1]], parsed))
+        return chapters
+
+    def _scan_paragraphs(self, chapters):
+        """Count the paragraphs for the progress bar and find the ones that
+        appear more than once in the book, they are translated only once."""
+        all_p_length = 0
+        seen = set()
+        repeated = set()
+        for chapter in chapters:
+            all_p_length += len(chapter.texts)
+            for text in chapter.texts:
+                key = normalize_text(text)
+                if key in seen:
+                    repeated.add(key)
+                else:
+                    seen.add(key)
+        return all_p_length, repeated
+
+    def _render_args(self, chapter, parsed=None):
+        return (
+            chapter.item.content,
+            self.trans_taglist,
+            self.allow_navigable_strings,
+            chapter.translations,
+            parsed,
+            self.parser,
+            # the texts of a parsed chapter are read from its tree
+            chapter.texts if parsed is None else None,
+        )
+
+    def _finish_chapter(self, chapter):
+        with metrics.timer("serialize"):
+            self._render_chapter(chapter)
+
+    def _render_chapter(self, chapter):
+        if self.pool is None:
+            chapter.item.content = render_chapter(
+                *self._render_args(chapter, chapter.parsed)
+            )
+            self._write_chapter(chapter)
+            return
+        future = self.pool.submit(render_chapter, *self._render_args(chapter))
+        self.rendering.append((chapter, future))
+        self._write_rendered()
+
+    def _write_rendered(self, wait=False):
+        """write the chapters rendered in the pool, in book order"""
+        while self.rendering and (wait or self.rendering[0][1].done()):
+            chapter, future = self.rendering.popleft()
+            chapter.item.content = future.result()
+            self._write_chapter(chapter)
+
+    def _write_chapter(self, chapter):
+        self.writer.add_item(chapter.item)
+        del self.in_progress[chapter.item.file_name]
+        chapter.parsed = None
+
+    def _batch_id(self, chapter, indices):
+        return f"{self.run_id}:{chapter.item.file_name}:{indices[0]}"
+
+    def _save_segment(self, payload, number, t_text):
+        """journal a paragraph of a streamed batch as soon as it arrives, so it
+        is not lost when the run stops before the batch is done. It is
+        provisional until the batch is checked and journaled again."""
+        chapter, indices, _ = payload
+        if number < len(indices):
+            i = indices[number]
+            self.journal.append(
+                chapter.item.file_name,
+                i,
+                chapter.texts[i],
+                t_text,
+                batch=self._batch_id(chapter, indices),
+            )
+
+    def _drop_segments(self, payload):
+        """the answer to a streamed batch did not match its paragraphs, the
+        segments journaled may be under the wrong ones"""
+        chapter, indices, _ = payload
+        self.journal.drop(self._batch_id(chapter, indices))
+
+    def _remember_repeated(self, text, t_text):
+        key = normalize_text(text)
+        if key in self.repeated and t_text is not None:
+            self.repeated_translations.setdefault(key, t_text)
+
+    def _iter_paragraph_jobs(self, chapters):
+        """Yield the paragraphs of every chapter in book order.
+
+        Each job is ``((chapter, i, saved), text)`` for the i-th text of the
+        chapter. Texts found in the journal by href and hash carry their saved
+        translation and no text, so no request is made for them. Later
+        occurrences of a repeated paragraph come as ``((chapter, i, None),
+        None)``, the caller reuses the translation of the first one. With
+        ``accumulated_num > 1`` the other paragraphs are sent in batches as
+        ``((chapter, [i, ...], None), [text, ...])``. After the last paragraph
+        of a chapter ``((chapter, None, None), None)`` is yielded so the caller
+        can write the finished chapter out.
+        """
+        index = 0
+        sent = set()
+
+        def is_repeat(text):
+            key = normalize_text(text)
+            if key not in self.repeated:
+                return False
+            if key in sent:
+                return True
+            sent.add(key)
+            return False
+
+        for chapter in chapters:
+            href = chapter.item.file_name
+            texts = chapter.texts
+            self.in_progress[href] = chapter
+            indices = range(len(texts))
+            if self.is_test:
+                indices = indices[: max(self.test_num - index, 0)]
+            saved = {}
+            if self.resumed:
+                for i in indices:
+                    key = href, text_hash(texts[i])
+                    if key in self.resumed:
+                        saved[i] = self.resumed[key]
+            if self.accumulated_num > 1:
+                to_send = []
+                later = []
+                for i in indices:
+                    if i in saved:
+                        is_repeat(texts[i])
+                        later.append(i)
+                    else:
+                        (later if is_repeat(texts[i]) else to_send).append(i)
+                for batch in self._pack_batches((i, texts[i]) for i in to_send):
+                    if len(batch) > 1:
+                        yield (chapter, [i for i, _ in batch], None), [
+                            text for _, text in batch
+                        ]
+                    else:
+                        # a single paragraph is sent as it is, not as a list
+                        yield (chapter, batch[0][0], None), batch[0][1]
+                for i in later:
+                    yield (chapter, i, saved.get(i)), None
+            else:
+                for i in indices:
+                    if i in saved:
+                        is_repeat(texts[i])
+                        yield (chapter, i, saved[i]), None
+                    elif is_repeat(texts[i]):
+                        yield (chapter, i, None), None
+                    else:
+                        yield (chapter, i, None), texts[i]
+            index += len(indices)
+            yield (chapter, None, None), None
 
     def load_state(self):
         try:
-            with open(self.bin_path, "rb") as f:
-                self.p_to_save = pickle.load(f)
+            self.resumed = self.journal.translations()
         except Exception:
             raise Exception("can not load resume file")
 
     def _save_temp_book(self):
-        origin_book_temp = epub.read_epub(self.epub_name)
-        new_temp_book = self._make_new_book(origin_book_temp)
-        p_to_save_len = len(self.p_to_save)
-        trans_taglist = self.translate_tags.split(",")
-        index = 0
+        """finish the bilingual book being written as the temp book: the
+        chapters in progress with the paragraphs translated so far and the
+        chapters not reached yet untranslated. When it can not be finished,
+        e.g. closing it failed, the temp book is built again from the journal."""
+        name, _ = os.path.splitext(self.epub_name)
+        temp_name = f"{name}_bilingual_temp.epub"
+        if getattr(self, "writer", None) is None or self.writer.state != "open":
+            if getattr(self, "writer", None) is not None:
+                self.writer.abort()
+            self._rebuild_temp_book(temp_name)
+            return
         try:
-            for item in origin_book_temp.get_items():
-                if item.get_type() == ITEM_DOCUMENT:
-                    soup = bs(item.content, "html.parser")
-                    p_list = soup.findAll(trans_taglist)
-                    for p in p_list:
-                        if not p.text or self._is_special_text(p.text):
-                            continue
-                        # TODO banch of p to translate then combine
-                        # PR welcome here
-                        if index < p_to_save_len:
-                            new_p = copy(p)
-                            new_p.string = self.p_to_save[index]
-                            print(new_p.string)
-                            p.insert_after(new_p)
-                            index += 1
-                        else:
-                            break
-                    # for save temp book
-                    item.content = soup.prettify().encode()
-                new_temp_book.add_item(item)
-            name, _ = os.path.splitext(self.epub_name)
-            epub.write_epub(f"{name}_bilingual_temp.epub", new_temp_book, {})
+            try:
+                self._write_rendered(wait=True)
+            except Exception:
+                # the pool is gone, e.g. interrupted as well, the chapters
+                # left are rendered here
+                self.rendering.clear()
+            for item in self.origin_book.get_items():
+                if item.file_name in self.writer.written:
+                    continue
+                chapter = self.in_progress.get(item.file_name)
+                if chapter is not None:
+                    item.content = render_chapter(
+                        *self._render_args(chapter, chapter.parsed)
+                    )
+                self.writer.add_item(item)
+            self.writer.close(temp_name)
         except Exception as e:
-            # TODO handle it
-            print(e)
+            logger.error("%s", e)
+            self.writer.abort()
+            self._rebuild_temp_book(temp_name)
+
+    def _rebuild_temp_book(self, temp_name):
+        """write the temp book from the source epub and the translations of
+        the journal, the documents already written are gone from memory"""
+        try:
+            translations = self.journal.translations()
+            book = read_epub(self.epub_name)
+            writer = StreamingEpubWriter(
+                temp_name, self._make_new_book(book), self.epub_name
+            )
+            writer.open()
+            try:
+                for item in book.get_items():
+                    if item.get_type() == ITEM_DOCUMENT:
+                        item.content = self._render_from_journal(item, translations)
+                    writer.add_item(item)
+                writer.close()
+            except Exception:
+                writer.abort()
+                raise
+        except Exception as e:
+            logger.error("can not save the temp book: %s", e)
+
+    def _render_from_journal(self, item, translations):
+        parsed = parse_chapter(
+            item.content, self.trans_taglist, self.allow_navigable_strings, self.parser
+        )
+        chapter = Chapter(item, [p.text for p in parsed[1]], parsed)
+        for i, text in enumerate(chapter.texts):
+            t_text = translations.get((item.file_name, text_hash(text)))
+            if t_text is not None:
+                chapter.translations[i] = t_text
+        return render_chapter(*self._render_args(chapter, parsed))
 
     def _save_progress(self):
         try:
-            with open(self.bin_path, "wb") as f:
-                pickle.dump(self.p_to_save, f)
+            self.journal.close()
         except Exception:
             raise Exception("can not save resume file")
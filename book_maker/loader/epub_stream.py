@@ -0,0 +1,163 @@
+import mimetypes
+import os
+import posixpath
+import shutil
+import zipfile
+
+from ebooklib import epub
+from ebooklib.utils import get_pages
+
+# media that is only copied to the bilingual book, never parsed
+PASSTHROUGH_TYPES = ("image", "audio", "video", "font")
+PASSTHROUGH_EXTENSIONS = (".ttf", ".otf", ".woff", ".woff2")
+
+
+def is_passthrough(file_name):
+    media_type = mimetypes.guess_type(file_name)[0] or ""
+    return (
+        media_type.split("/")[0] in PASSTHROUGH_TYPES
+        or media_type.startswith("application/font")
+        or file_name.lower().endswith(PASSTHROUGH_EXTENSIONS)
+    )
+
+
+class LazyEpubReader(epub.EpubReader):
+    """
+    an EpubReader that leaves images, fonts and other media in the zip file,
+    their items get an empty content and a `source_path` to copy them from
+    """
+
+    def read_file(self, name):
+        if is_passthrough(name):
+            self.skipped.add(posixpath.normpath(name))
+            return b""
+        return super().read_file(name)
+
+    def load(self):
+        self.skipped = set()
+        book = super().load()
+        for item in book.get_items():
+            path = posixpath.normpath(posixpath.join(self.opf_dir, item.file_name))
+            if path in self.skipped:
+                item.source_path = path
+        return book
+
+
+def read_epub(name):
+    reader = LazyEpubReader(name)
+    book = reader.load()
+    reader.process()
+    return book
+
+
+class StreamingEpubWriter(epub.EpubWriter):
+    """
+    write the items of an EpubBook to the zip file one by one, as soon as
+    they are added, instead of the whole book at the end
+
+    Media items are copied straight from the `source` epub, documents are
+    written with their markup as it is and their content is dropped once
+    written, so the memory used does not grow with the size of the book. The
+    book is written to `<name>.part` and renamed to `name` by `close`, the
+    navigation and the OPF are written last.
+
+    `state` is "new", "open" while items can be added, "closing" once `close`
+    started (and still when it failed), "closed" or "aborted".
+    """
+
+    def __init__(self, name, book, source, options=None):
+        super().__init__(name, book, options)
+        self.source = source
+        self.part_name = f"{name}.part"
+        self.pages = []
+        self.written = set()
+        self.state = "new"
+        self.out = None
+        self.source_zip = None
+
+    def open(self):
+        self.out = zipfile.ZipFile(
+            self.part_name,
+            "w",
+            zipfile.ZIP_DEFLATED,
+            compresslevel=self.options.get("compresslevel", 6),
+        )
+        self.out.writestr(
+            "mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED
+        )
+        self._write_container()
+        self.source_zip = zipfile.ZipFile(self.source)
+        self.state = "open"
+
+    def add_item(self, item):
+        self.book.add_item(item)
+        self.written.add(item.file_name)
+        if isinstance(item, (epub.EpubNcx, epub.EpubNav)):
+            # built from the toc when the book is closed
+            return
+        if item.manifest:
+            arcname = f"{self.book.FOLDER_NAME}/{item.file_name}"
+        else:
+            arcname = item.file_name
+        source_path = getattr(item, "source_path", None)
+        if source_path is not None:
+            with self.source_zip.open(source_path) as src, self.out.open(
+                arcname, "w"
+            ) as dst:
+                shutil.copyfileobj(src, dst)
+            return
+        if isinstance(item, epub.EpubHtml) and item.content:
+            # written as they are, get_content would parse them again and
+            # print them its own way, with another head and xml declaration
+            self.out.writestr(arcname, item.content)
+        else:
+            self.out.writestr(arcname, item.get_content())
+        if isinstance(item, epub.EpubHtml):
+            # the page list of the navigation needs the documents, take it
+            # now because their content is dropped
+            if self.options.get("epub3_pages"):
+                self.pages.extend(get_pages(item))
+            item.content = b""
+
+    def _get_nav(self, item):
+        get_pages_for_items = epub.get_pages_for_items
+        epub.get_pages_for_items = lambda items: self.pages
+        try:
+            return super()._get_nav(item)
+        finally:
+            epub.get_pages_for_items = get_pages_for_items
+
+    def close(self, name=None):
+        """write the navigation and the OPF and move the book to `name`,
+        by default the name it was created with"""
+        self.state = "closing"
+        for item in self.book.get_items():
+            if isinstance(item, epub.EpubNcx):
+                self.out.writestr(
+                    f"{self.book.FOLDER_NAME}/{item.file_name}", self._get_ncx()
+                )
+            elif isinstance(item, epub.EpubNav):
+                self.out.writestr(
+                    f"{self.book.FOLDER_NAME}/{item.file_name}", self._get_nav(item)
+                )
+        self._write_opf()
+        self.out.close()
+        self.source_zip.close()
+        os.replace(self.part_name, name or self.file_name)
+        self.state = "closed"
+
+    def abort(self):
+        """close the files, whatever state they are in, and remove the
+        unfinished book"""
+        if self.state in ("closed", "aborted"):
+            return
+        self.state = "aborted"
+        for f in (self.out, self.source_zip):
+            if f is None:
+                continue
+            try:
+                f.close()
+            except Exception:
+                pass
+        if os.path.exists(self.part_name):
+            os.remove(self.part_name)
@@ -1 +1,97 @@
-"""TODO"""
+from itertools import chain, islice
+
+from .txt_loader import TXTBookLoader
+
+
+class SRTBookLoader(TXTBookLoader):
+    """
+    translate a subtitle file cue by cue as a stream, like a text file: the
+    number and the timing of every cue are kept as they are and its
+    translation follows its text.
+
+    The cues are always sent in batches under the token budgets, of
+    `window_tokens` tokens of text when `accumulated_num` is not given, so a
+    film takes dozens of requests rather than one for every cue. Resuming goes
+    on from the cue after the last one saved.
+    """
+
+    extension = "srt"
+    # tokens of cue text sent in one request without accumulated_num
+    window_tokens = 1000
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.accumulated_num <= 1:
+            self.accumulated_num = self.window_tokens
+
+    def _iter_blocks(self, offset):
+        """yield ``(end, lines)`` for the blocks of lines between blank lines
+        from byte `offset`"""
+        lines = []
+        end = offset
+        for line_end, line in self._iter_lines(offset):
+            if not line.strip():
+                if lines:
+                    yield end, lines
+                    lines = []
+                continue
+            lines.append(line)
+            end = line_end
+        if lines:
+            yield end, lines
+
+    def _cue_text(self, lines):
+        """the text to translate of a cue, None for a block without a timing
+        or a text"""
+        for i, line in enumerate(lines):
+            if "-->" in line:
+                if i + 1 < len(lines):
+                    return self._join_lines(lines[i + 1 :])
+                return None
+        return None
+
+    def _iter_cues(self, offset):
+        """yield ``((end, cues), text)`` for every cue with a text, with the
+        blocks without one that follow it, they are written out as they are.
+        Blocks without a text at the start come first with a None text."""
+        cues = []
+        text = None
+        end = offset
+        for block_end, lines in self._iter_blocks(offset):
+            cue_text = self._cue_text(lines)
+            if cue_text is not None and cues:
+                yield (end, cues), text
+                cues = []
+            if not cues:
+                text = cue_text
+            cues.append(lines)
+            end = block_end
+        if cues:
+            yield (end, cues), text
+
+    def _iter_paragraph_jobs(self):
+        """yield ``([(end, cues), ...], [text, ...])`` for the batches of cues
+        left to translate"""
+        items = self._iter_cues(self.offset)
+        if self.is_test:
+            items = islice(items, max(self.test_num + 1 - self.index, 0))
+        first = next(items, None)
+        if first is None:
+            return
+        if first[1] is None:
+            yield [first[0]], None
+        else:
+            items = chain([first], items)
+        for batch in self._pack_batches(items):
+            if len(batch) > 1:
+                yield [p for p, _ in batch], [text for _, text in batch]
+            else:
+                yield [batch[0][0]], batch[0][1]
+
+    def _write_paragraph(self, cues, t_text):
+        for lines in cues:
+            if t_text is None:
+                self._write_output(*lines, "")
+            else:
+                self._write_output(*lines, t_text, "")
+                t_text = None
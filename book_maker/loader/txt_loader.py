@@ -1,10 +1,59 @@
+import logging
+import mmap
+import os
 import sys
+import time
+import unicodedata
+from collections import Counter
+from itertools import islice, zip_longest
 from pathlib import Path
 
+from book_maker.metrics import metrics
+
 from .base_loader import BaseBookLoader
+from .checkpoint import OffsetCheckpoint
+
+logger = logging.getLogger(__name__)
+
+# a line ending with one of these and clearly shorter than the wrap width
+# ends its paragraph
+SENTENCE_ENDS = tuple(".!?:;\"')]…”’»。！？：；」』）】")
+
+
+def display_width(text):
+    """the columns `text` takes, wide east asian characters take two"""
+    return sum(2 if unicodedata.east_asian_width(c) in "WF" else 1 for c in text)
 
 
 class TXTBookLoader(BaseBookLoader):
+    """
+    translate a text file paragraph by paragraph as a stream: the book is
+    mapped in memory and read lazily, the bilingual paragraphs are written to
+    the temp book as they are translated, so the memory used does not grow
+    with the book.
+
+    The lines of a hard wrapped paragraph are joined to be translated, the
+    translation follows the last of them. With `accumulated_num` > 1 the
+    paragraphs are sent in batches under the token budgets.
+
+    The byte offsets reached in the book and in the temp book are saved every
+    `flush_interval` seconds and when the run stops, resuming truncates the
+    temp book there and goes on from that line of the book.
+    """
+
+    # of the bilingual book
+    extension = "txt"
+    flush_interval = 5
+    # bytes of the mapped book read before its pages are released
+    release_size = 64 * 1024 * 1024
+    # lines at the start of the book measured to find its wrap width
+    wrap_sample_lines = 1000
+    # lines narrower than this are not measured, they are never wrapped
+    min_wrap_width = 20
+    # a line ending a sentence ends its paragraph when it fills less than this
+    # share of the wrap width, any other line when it fills less than half
+    sentence_end_fill = 0.8
+
     def __init__(
         self,
         txt_name,
@@ -18,24 +67,37 @@ class TXTBookLoader(BaseBookLoader):
         is_test=False,
         test_num=5,
         accumulated_num=1,
+        accumulated_output_num=2048,
+        workers=1,
     ):
         self.txt_name = txt_name
         self.translate_model = model(key, language, model_api_base)
         self.is_test = is_test
-        self.p_to_save = []
-        self.bilingual_result = []
-        self.bilingual_temp_result = []
         self.test_num = test_num
+        self.workers = workers
+        self.accumulated_num = accumulated_num
+        self.accumulated_output_num = accumulated_output_num
+        # paragraphs translated so far, and the byte offsets after the last one in
+        # the book and in the temp book
+        self.index = 0
+        self.offset = 0
+        self.output_offset = 0
+        self.output = None
+        self.last_save = time.monotonic()
+        # measured when the paragraphs are first read, None when the book is
+        # not hard wrapped
+        self.wrap_width = None
 
         try:
-            with open(f"{txt_name}", "r", encoding="utf-8") as f:
-                self.origin_book = f.read().split("\n")
-
+            self.book_size = os.path.getsize(txt_name)
         except Exception:
             raise Exception("can not load file")
 
+        path = Path(txt_name)
+        self.bilingual_path = f"{path.parent}/{path.stem}_bilingual.{self.extension}"
+        self.temp_path = f"{path.parent}/{path.stem}_bilingual_temp.{self.extension}"
         self.resume = resume
-        self.bin_path = f"{Path(txt_name).parent}/.{Path(txt_name).stem}.temp.bin"
+        self.checkpoint = OffsetCheckpoint(f"{path.parent}/.{path.stem}.temp.json")
         if self.resume:
             self.load_state()
 
@@ -46,69 +108,218 @@ class TXTBookLoader(BaseBookLoader):
     def _make_new_book(self, book):
         pass
 
-    def make_bilingual_book(self):
-        index = 0
-        p_to_save_len = len(self.p_to_save)
+    def _iter_lines(self, offset):
+        """yield ``(end, line)`` for the lines of the book from byte `offset`,
+        `end` is the offset of the line after"""
+        if offset >= self.book_size:
+            # an empty file can not be mapped
+            return
+        with open(self.txt_name, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as book:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                book.madvise(mmap.MADV_SEQUENTIAL)
+            book.seek(offset)
+            released = offset - offset % mmap.PAGESIZE
+            while True:
+                line = book.readline()
+                if not line:
+                    break
+                if (
+                    hasattr(mmap, "MADV_DONTNEED")
+                    and book.tell() - released >= self.release_size
+                ):
+                    # the pages read stay resident otherwise
+                    end = book.tell() - book.tell() % mmap.PAGESIZE
+                    book.madvise(mmap.MADV_DONTNEED, released, end - released)
+                    released = end
+                if line.endswith(b"\n"):
+                    line = line[:-1]
+                if line.endswith(b"\r"):
+                    line = line[:-1]
+                yield book.tell(), line.decode("utf-8")
 
-        try:
-            for i in self.origin_book:
-                if self._is_special_text(i):
-                    continue
-                if self.resume and index < p_to_save_len:
-                    pass
+    def _measure_wrap_width(self):
+        """the width the book is hard wrapped at, the most common width of its
+        first lines. None when most of them are not about that wide, the book
+        is not wrapped then and every line is a paragraph. The start of the
+        book is measured on resume too, so the paragraphs come out the same."""
+        widths = Counter()
+        for _, line in islice(self._iter_lines(0), self.wrap_sample_lines):
+            width = display_width(line.rstrip())
+            if width >= self.min_wrap_width:
+                widths[width] += 1
+        if not widths:
+            return None
+        wrap_width = widths.most_common(1)[0][0]
+        low = wrap_width * self.sentence_end_fill
+        wrapped = sum(n for w, n in widths.items() if low <= w <= wrap_width * 1.1)
+        if wrapped * 2 < sum(widths.values()):
+            return None
+        return wrap_width
+
+    def _continues(self, line, next_line):
+        """whether `next_line` goes on the paragraph hard wrapped after
+        `line`: an indented line starts a paragraph, a line wider than the
+        wrap width is not wrapped and a line ending a sentence is only wrapped
+        when it is about as wide as the wrap width"""
+        if self.wrap_width is None or next_line[0].isspace():
+            return False
+        line = line.rstrip()
+        width = display_width(line)
+        if width > self.wrap_width * 1.1:
+            return False
+        if line.endswith(SENTENCE_ENDS):
+            return width >= self.wrap_width * self.sentence_end_fill
+        return width >= self.wrap_width / 2
+
+    def _iter_paragraphs(self, offset):
+        """yield ``(end, lines)`` for the paragraphs of the book from byte
+        `offset`, `end` is the offset of the line after the last one. Blank
+        lines end a paragraph, page numbers are left out."""
+        self.wrap_width = self._measure_wrap_width()
+        lines = []
+        end = offset
+        for line_end, line in self._iter_lines(offset):
+            if self._is_special_text(line):
+                if lines and not line.strip():
+                    yield end, lines
+                    lines = []
+                continue
+            if lines and not self._continues(lines[-1], line):
+                yield end, lines
+                lines = []
+            lines.append(line)
+            end = line_end
+        if lines:
+            yield end, lines
+
+    @staticmethod
+    def _join_lines(lines):
+        """the text of a paragraph, its lines joined by spaces except between
+        two wide characters"""
+        if len(lines) == 1:
+            return lines[0]
+        text = lines[0].strip()
+        for line in lines[1:]:
+            line = line.strip()
+            if display_width(text[-1] + line[0]) < 4:
+                text += " "
+            text += line
+        return text
+
+    def _iter_paragraph_jobs(self):
+        """yield ``([(end, lines)], text)`` for the paragraphs left to
+        translate, with ``accumulated_num > 1`` batches of them as
+        ``([(end, lines), ...], [text, ...])``"""
+        paragraphs = self._iter_paragraphs(self.offset)
+        if self.is_test:
+            paragraphs = islice(paragraphs, max(self.test_num + 1 - self.index, 0))
+        items = ((p, self._join_lines(p[1])) for p in paragraphs)
+        if self.accumulated_num > 1:
+            for batch in self._pack_batches(items):
+                if len(batch) > 1:
+                    yield [p for p, _ in batch], [text for _, text in batch]
                 else:
-                    temp = self.translate_model.translate(i)
-                    self.p_to_save.append(temp)
-                    self.bilingual_result.append(i)
-                    self.bilingual_result.append(temp)
-                index += 1
-                if self.is_test and index > self.test_num:
-                    break
+                    # a single paragraph is sent as it is, not as a list
+                    yield [batch[0][0]], batch[0][1]
+        else:
+            for p, text in items:
+                yield [p], text
 
-            self.save_file(
-                f"{Path(self.txt_name).parent}/{Path(self.txt_name).stem}_bilingual.txt",
-                self.bilingual_result,
-            )
+    def make_bilingual_book(self):
+        try:
+            self._open_output()
+            jobs = self._iter_paragraph_jobs()
+            for paragraphs, t_text in self._translate_in_order(jobs):
+                if not isinstance(t_text, list):
+                    t_text = [t_text]
+                # paragraphs missing from the answer to a batch stay
+                # untranslated
+                for p, temp in zip_longest(paragraphs, t_text[: len(paragraphs)]):
+                    end, lines = p
+                    self._write_paragraph(lines, temp)
+                    self.offset = end
+                self.index += len(paragraphs)
+                metrics.inc("paragraphs_total", len(paragraphs), source="translated")
+                if time.monotonic() - self.last_save >= self.flush_interval:
+                    self._save_progress()
+
+            self.output.close()
+            self.output = None
+            os.replace(self.temp_path, self.bilingual_path)
+            self.checkpoint.remove()
 
         except (KeyboardInterrupt, Exception) as e:
-            print(e)
-            print("you can resume it next time")
+            logger.error("%s", e)
+            logger.error("you can resume it next time")
             self._save_progress()
             self._save_temp_book()
             sys.exit(0)
 
-    def _save_temp_book(self):
-        index = 0
-        for i in range(0, len(self.origin_book)):
-            self.bilingual_temp_result.append(self.origin_book[i])
-            if self._is_special_text(self.origin_book[i]):
-                continue
-            if index < len(self.p_to_save):
-                self.bilingual_temp_result.append(self.p_to_save[index])
-            index += 1
+    def _open_output(self):
+        if self.offset and not os.path.exists(self.temp_path):
+            logger.warning("%s is missing, starting over", self.temp_path)
+            self.index = self.offset = self.output_offset = 0
+        if self.offset:
+            # drop what was written after the saved progress
+            self.output = open(self.temp_path, "r+b")
+            self.output.truncate(self.output_offset)
+            self.output.seek(self.output_offset)
+        else:
+            self.output = open(self.temp_path, "wb")
 
-        self.save_file(
-            f"{Path(self.txt_name).parent}/{Path(self.txt_name).stem}_bilingual_temp.txt",
-            self.bilingual_temp_result,
-        )
+    def _write_paragraph(self, lines, t_text):
+        if t_text is None:
+            self._write_output(*lines)
+        else:
+            self._write_output(*lines, t_text)
+
+    def _write_output(self, *lines):
+        with metrics.timer("serialize"):
+            text = "\n".join(lines)
+            if self.output.tell():
+                text = "\n" + text
+            self.output.write(text.encode("utf-8"))
+            self.output_offset = self.output.tell()
+
+    def _save_temp_book(self):
+        # the temp book is written as the lines are translated
+        if self.output is not None:
+            self.output.close()
+            self.output = None
 
     def _save_progress(self):
+        if self.output is None:
+            return
         try:
-            with open(self.bin_path, "w") as f:
-                f.write("\n".join(self.p_to_save))
+            self.output.flush()
+            os.fsync(self.output.fileno())
+            self.checkpoint.save(
+                {
+                    "size": self.book_size,
+                    "offset": self.offset,
+                    "output_offset": self.output_offset,
+                    "index": self.index,
+                }
+            )
         except:
             raise Exception("can not save resume file")
+        self.last_save = time.monotonic()
 
     def load_state(self):
         try:
-            with open(self.bin_path, "r", encoding="utf-8") as f:
-                self.p_to_save = f.read().split("\n")
+            state = self.checkpoint.load()
         except Exception:
             raise Exception("can not load resume file")
-
-    def save_file(self, book_path, content):
-        try:
-            with open(book_path, "w", encoding="utf-8") as f:
-                f.write("\n".join(content))
-        except:
-            raise Exception("can not save file")
+        if state is None:
+            return
+        if state["size"] != self.book_size:
+            logger.warning(
+                "%s changed since the last run, starting over", self.txt_name
+            )
+            return
+        self.offset = state["offset"]
+        self.output_offset = state["output_offset"]
+        self.index = state["index"]
+        metrics.inc("paragraphs_total", self.index, source="resumed")
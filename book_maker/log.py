@@ -0,0 +1,35 @@
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_LEVELS = ("debug", "info", "warning", "error")
+
+
+def setup_logging(level="info", log_file=None):
+    """
+    send the records of book_maker through a queue to stderr and `log_file`,
+    they are written by a background thread so translating never waits on
+    the terminal or the disk. Return the listener, stop it to flush the
+    records left.
+
+    The texts and translations of the paragraphs are logged at debug level.
+    """
+    console = logging.StreamHandler(sys.stderr)
+    console.setFormatter(logging.Formatter("%(message)s"))
+    handlers = [console]
+    if log_file:
+        file_handler = logging.FileHandler(log_file, encoding="utf-8")
+        file_handler.setFormatter(
+            logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+        )
+        handlers.append(file_handler)
+    records = queue.SimpleQueue()
+    logger = logging.getLogger("book_maker")
+    logger.setLevel(level.upper())
+    logger.addHandler(QueueHandler(records))
+    # the records are not handled twice by a root logger set up by others
+    logger.propagate = False
+    listener = QueueListener(records, *handlers)
+    listener.start()
+    return listener
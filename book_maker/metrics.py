@@ -0,0 +1,178 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds in seconds of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+PREFIX = "bilingual_book_maker_"
+
+
+def _labels(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+class Metrics:
+    """
+    counters, latency histograms and the time spent in every stage of a run,
+    recorded from any thread, reported as a JSON summary or a Prometheus
+    textfile
+
+    Stages: "parse" (reading the book), "network" (requests, retries
+    included), "serialize" (rendering and writing the book) and
+    "checkpoint" (the resume journal). Stages overlap when requests run in
+    parallel.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters = {}
+            self.histograms = {}
+        self._textfile_stop = None
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    "buckets": [0] * len(LATENCY_BUCKETS),
+                    "count": 0,
+                    "sum": 0.0,
+                }
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["count"] += 1
+            histogram["sum"] += value
+
+    def add_time(self, stage, seconds):
+        self.inc("stage_seconds_total", seconds, stage=stage)
+
+    @contextmanager
+    def timer(self, stage):
+        """add the time the block takes to `stage`"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def summary(self):
+        with self.lock:
+            counters = {}
+            for (name, labels), value in sorted(self.counters.items()):
+                counters.setdefault(name, []).append(
+                    {"labels": dict(labels), "value": value}
+                )
+            histograms = {}
+            for (name, labels), h in sorted(self.histograms.items()):
+                histograms.setdefault(name, []).append(
+                    {
+                        "labels": dict(labels),
+                        "count": h["count"],
+                        "sum": h["sum"],
+                        "mean": h["sum"] / h["count"],
+                        "buckets": dict(zip(map(str, LATENCY_BUCKETS), h["buckets"])),
+                    }
+                )
+        stages = {
+            c["labels"]["stage"]: c["value"]
+            for c in counters.get("stage_seconds_total", [])
+        }
+        return {
+            "started": self.started,
+            "elapsed_seconds": time.time() - self.started,
+            "stages": stages,
+            "counters": counters,
+            "histograms": histograms,
+        }
+
+    def prometheus(self):
+        """the metrics in the Prometheus text format"""
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {PREFIX}{name} counter")
+                typed.add(name)
+            lines.append(f"{PREFIX}{name}{_format_labels(labels)} {value}")
+        for (name, labels), h in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                typed.add(name)
+            for bound, count in zip(LATENCY_BUCKETS, h["buckets"]):
+                le = _format_labels(labels, [("le", str(bound))])
+                lines.append(f"{PREFIX}{name}_bucket{le} {count}")
+            le = _format_labels(labels, [("le", "+Inf")])
+            lines.append(f"{PREFIX}{name}_bucket{le} {h['count']}")
+            lines.append(f"{PREFIX}{name}_sum{_format_labels(labels)} {h['sum']}")
+            lines.append(f"{PREFIX}{name}_count{_format_labels(labels)} {h['count']}")
+        lines.append(f"# TYPE {PREFIX}start_time_seconds gauge")
+        lines.append(f"{PREFIX}start_time_seconds {self.started}")
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path):
+        _write_atomic(path, json.dumps(self.summary(), indent=2))
+
+    def write_textfile(self, path):
+        _write_atomic(path, self.prometheus())
+
+    def start_textfile(self, path, interval=15):
+        """rewrite the textfile every `interval` seconds until `stop_textfile`,
+        so a long run can be watched"""
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                self.write_textfile(path)
+
+        self._textfile_stop = stop
+        threading.Thread(target=run, daemon=True).start()
+
+    def stop_textfile(self):
+        if self._textfile_stop is not None:
+            self._textfile_stop.set()
+            self._textfile_stop = None
+
+
+def _write_atomic(path, text):
+    # a collector never reads a half written file
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def key_label(key):
+    """an api key as a metric label, without giving it away"""
+    return f"...{key[-4:]}" if len(key) > 8 else "key"
+
+
+# shared by the loaders and translators of a run
+metrics = Metrics()
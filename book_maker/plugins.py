@@ -0,0 +1,77 @@
+import importlib
+import logging
+from collections.abc import Mapping
+
+logger = logging.getLogger(__name__)
+
+
+def _entry_points(group):
+    # importlib.metadata takes longer to import than the rest of the cli
+    from importlib import metadata
+
+    eps = metadata.entry_points()
+    if hasattr(eps, "select"):
+        return eps.select(group=group)
+    # python < 3.10
+    return eps.get(group, [])
+
+
+class LazyRegistry(Mapping):
+    """
+    names of the loaders or translators and their classes, a class is only
+    imported when it is looked up so the cli does not pay for the
+    dependencies of the ones it does not use
+
+    The built in classes are given as "module:Class" paths. Other packages add
+    theirs through the entry point `group`, e.g. in their pyproject.toml
+
+        [project.entry-points."bilingual_book_maker.translators"]
+        deepl = "my_package.deepl:DeepL"
+
+    Entry points are only looked for when a name is not built in, built in
+    names can not be overridden.
+    """
+
+    def __init__(self, group, builtins):
+        self.group = group
+        self.paths = dict(builtins)
+        self.classes = {}
+        self._plugins = None
+
+    def _discover(self):
+        if self._plugins is None:
+            self._plugins = {}
+            try:
+                for ep in _entry_points(self.group):
+                    if ep.name not in self.paths:
+                        self._plugins[ep.name] = ep
+            except Exception as e:
+                logger.warning("could not look for %s plugins: %s", self.group, e)
+        return self._plugins
+
+    def _load(self, name):
+        if name in self.paths:
+            module, _, attr = self.paths[name].partition(":")
+            return getattr(importlib.import_module(module), attr)
+        return self._discover()[name].load()
+
+    def __getitem__(self, name):
+        if name not in self.classes:
+            if name not in self.paths and name not in self._discover():
+                raise KeyError(name)
+            self.classes[name] = self._load(name)
+        return self.classes[name]
+
+    def __contains__(self, name):
+        return name in self.paths or name in self._discover()
+
+    def __iter__(self):
+        yield from self.paths
+        yield from self._discover()
+
+    def __len__(self):
+        return len(self.paths) + len(self._discover())
+
+    def builtin_names(self):
+        """the built in names, without looking for plugins"""
+        return list(self.paths)
@@ -1,10 +1,13 @@
-from book_maker.translator.chatgptapi_translator import ChatGPTAPI
-from book_maker.translator.google_translator import Google
-from book_maker.translator.gpt3_translator import GPT3
+from book_maker.plugins import LazyRegistry
 
-MODEL_DICT = {
-    "chatgptapi": ChatGPTAPI,
-    "gpt3": GPT3,
-    "google": Google
-    # add more here
-}
+# the translators are only imported when they are used, e.g. openai is not
+# imported for google
+MODEL_DICT = LazyRegistry(
+    "bilingual_book_maker.translators",
+    {
+        "chatgptapi": "book_maker.translator.chatgptapi_translator:ChatGPTAPI",
+        "gpt3": "book_maker.translator.gpt3_translator:GPT3",
+        "google": "book_maker.translator.google_translator:Google",
+        # add more here
+    },
+)
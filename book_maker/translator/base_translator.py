@@ -1,11 +1,313 @@
-import itertools
+import asyncio
+import json
+import logging
+import random
+import sys
+import time
 from abc import ABC, abstractmethod
+from email.utils import parsedate_to_datetime
+
+from book_maker.metrics import key_label, metrics
+
+from .key_scheduler import KeyScheduler
+
+logger = logging.getLogger(__name__)
+
+# errors worth another attempt, the others are raised at once
+RETRYABLE_ERRORS = {"rate_limit", "server", "timeout"}
+
+
+class APIError(Exception):
+    """an error status returned to an async request"""
+
+    def __init__(self, status, body, headers=None):
+        self.http_status = status
+        self.headers = headers
+        self.code = None
+        message = body
+        try:
+            error = json.loads(body)["error"]
+            if isinstance(error, dict):
+                self.code = error.get("code")
+                message = error.get("message") or body
+        except Exception:
+            pass
+        super().__init__(f"{status} {message}")
+
+
+class Lines:
+    """lines joined only when they are formatted, for debug logs of batches
+    that are not built when debug is off"""
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    def __str__(self):
+        return "\n".join(self.lines)
+
+
+def classify_error(e):
+    """
+    tell what went wrong with a request, one of "rate_limit", "server",
+    "timeout", "context_length", "auth" (also a key out of quota) or "other"
+    """
+    status = getattr(e, "http_status", None)
+    response = getattr(e, "response", None)
+    if status is None and response is not None:
+        status = getattr(response, "status_code", None)
+    code = getattr(e, "code", None)
+    if code is None and response is not None:
+        try:
+            code = response.json()["error"]["code"]
+        except Exception:
+            pass
+    if code == "context_length_exceeded" or "maximum context length" in str(e):
+        return "context_length"
+    if status in (401, 403) or code == "insufficient_quota":
+        return "auth"
+    if status == 429:
+        return "rate_limit"
+    if status is not None and status >= 500:
+        return "server"
+    name = type(e).__name__
+    if name in ("ServiceUnavailableError", "TryAgain"):
+        return "server"
+    # openai.error.Timeout, requests.Timeout, asyncio.TimeoutError and the
+    # dropped connections of openai, requests and aiohttp. aiohttp is only
+    # imported by the async translators, an error of it can not come before
+    aiohttp = sys.modules.get("aiohttp")
+    if (
+        "Timeout" in name
+        or name in ("APIConnectionError", "ConnectionError")
+        or isinstance(e, (TimeoutError, ConnectionError))
+        or (aiohttp is not None and isinstance(e, aiohttp.ClientConnectionError))
+    ):
+        return "timeout"
+    return "other"
+
+
+def retry_after(e):
+    """seconds the server asked to wait, from the Retry-After header"""
+    headers = getattr(e, "headers", None)
+    response = getattr(e, "response", None)
+    if not headers and response is not None:
+        headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except Exception:
+        return None
 
 
 class Base(ABC):
+    # retries of a request after the first attempt
+    max_retries = 6
+    # seconds before the first retry, doubled for every further one
+    backoff_base = 2
+    backoff_max = 60
+    # seconds a single attempt may take
+    timeout = 120
+    # seconds a request may take over all its attempts
+    deadline = 600
+    # connections the async client keeps open to the API
+    max_connections = 64
+    # translators with `atranslate` and `atranslate_list`, which many
+    # requests can share on one event loop
+    is_async = False
+
     def __init__(self, key, language):
-        self.keys = itertools.cycle(key.split(","))
+        self.keys = KeyScheduler(key.split(","))
         self.language = language
+        # completion tokens per source token, updated from the usage of the
+        # responses, it starts high so the first batches are not too big
+        self.output_ratio = 2.0
+        self._encoding = None
+        self._session = None
+
+    def set_rate_limits(self, rpm=None, tpm=None):
+        """limit every key to `rpm` requests and `tpm` tokens per minute,
+        one value for all keys or one per key"""
+        self.keys = KeyScheduler(self.keys.keys, rpm, tpm)
+
+    @staticmethod
+    def estimate_tokens(text):
+        # about four latin characters per token, one for most other scripts
+        return sum(1 if ord(c) > 0x7F else 0.25 for c in text)
+
+    def count_tokens(self, text):
+        """tokens of `text` for the model of this translator"""
+        if self._encoding is None:
+            try:
+                # tiktoken takes a while to import, only translators counting
+                # tokens need it
+                import tiktoken
+
+                try:
+                    self._encoding = tiktoken.encoding_for_model(
+                        getattr(self, "model", "")
+                    )
+                except KeyError:
+                    self._encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception:
+                # tiktoken or the encoding could not be loaded, count roughly
+                self._encoding = False
+        if self._encoding is False:
+            return int(self.estimate_tokens(text)) + 1
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    def expected_output_tokens(self, text):
+        return int(self.count_tokens(text) * self.output_ratio) + 1
+
+    def update_output_ratio(self, text, completion_tokens):
+        ratio = completion_tokens / max(self.count_tokens(text), 1)
+        self.output_ratio = 0.8 * self.output_ratio + 0.2 * ratio
+
+    def record_usage(self, key, usage, text, estimated_tokens):
+        """correct the tokens counted for `key` and the output ratio with the
+        usage of a response"""
+        usage = usage or {}
+        if "total_tokens" in usage:
+            self.keys.adjust(key, usage["total_tokens"] - estimated_tokens)
+        if "completion_tokens" in usage:
+            self.update_output_ratio(text, usage["completion_tokens"])
+        for kind in ("prompt_tokens", "completion_tokens"):
+            if kind in usage:
+                metrics.inc(f"{kind}_total", usage[kind], key=key_label(key))
+
+    def backoff(self, attempt):
+        """capped exponential backoff with jitter for the `attempt`-th retry"""
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+        return random.uniform(delay / 2, delay)
+
+    def call_with_retry(self, request, tokens=0):
+        """
+        call `request(key)` with a key from the scheduler and retry the
+        failures that may pass on another try
+
+        Rate limited keys cool down for the time asked in Retry-After and the
+        retry goes to a key with room left. Server errors and timeouts wait
+        with exponential backoff. Keys rejected as invalid are dropped. Other
+        errors, too long inputs and requests over `deadline` are raised.
+        """
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            key = self.keys.acquire(tokens)
+            start = time.perf_counter()
+            try:
+                result = request(key)
+            except Exception as e:
+                self._record_request(start, classify_error(e))
+                attempt, delay = self._after_failure(e, key, attempt, deadline)
+                time.sleep(delay)
+            else:
+                self._record_request(start, "ok")
+                return result
+
+    async def acall_with_retry(self, request, tokens=0):
+        """`call_with_retry` for a coroutine function `request(key)`"""
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            key = await self.keys.aacquire(tokens)
+            start = time.perf_counter()
+            try:
+                result = await request(key)
+            except Exception as e:
+                self._record_request(start, classify_error(e))
+                attempt, delay = self._after_failure(e, key, attempt, deadline)
+                await asyncio.sleep(delay)
+            else:
+                self._record_request(start, "ok")
+                return result
+
+    def _record_request(self, start, outcome):
+        elapsed = time.perf_counter() - start
+        translator = type(self).__name__
+        metrics.observe("request_seconds", elapsed, translator=translator)
+        metrics.inc("requests_total", translator=translator, outcome=outcome)
+        metrics.add_time("network", elapsed)
+
+    def _after_failure(self, e, key, attempt, deadline):
+        """
+        raise `e` if the request should not be tried again, otherwise return
+        the number of attempts made and the seconds to wait before the next
+        """
+        kind = classify_error(e)
+        if kind == "auth" and len(self.keys) > 1:
+            logger.warning("%s, the key is dropped", e)
+            metrics.inc("keys_dropped_total")
+            self.keys.disable(key)
+            return attempt, 0
+        attempt += 1
+        if kind not in RETRYABLE_ERRORS or attempt > self.max_retries:
+            raise e
+        delay = retry_after(e)
+        if delay is None:
+            delay = self.backoff(attempt)
+        if time.monotonic() + delay > deadline:
+            raise e
+        metrics.inc("retries_total", kind=kind)
+        if kind == "rate_limit":
+            logger.warning("%s, the key will rest %.1f seconds", e, delay)
+            self.keys.cool_down(key, delay)
+            return attempt, 0
+        logger.warning("%s, will retry in %.1f seconds", e, delay)
+        return attempt, delay
+
+    async def http_session(self):
+        """the pooled keep-alive session of the async requests, made on first
+        use in the running event loop"""
+        if self._session is None:
+            import aiohttp
+
+            # trust_env picks up the proxy set by --proxy
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                trust_env=True,
+            )
+        return self._session
+
+    async def apost(self, url, **kwargs):
+        """post with the async session and return the decoded JSON answer,
+        an error status is raised as an APIError"""
+        session = await self.http_session()
+        async with session.post(url, **kwargs) as r:
+            body = await r.text()
+            if r.status >= 400:
+                raise APIError(r.status, body, r.headers)
+            return json.loads(body)
+
+    async def apost_stream(self, url, **kwargs):
+        """post with the async session and yield the decoded data of every
+        server-sent event of the answer as it arrives"""
+        session = await self.http_session()
+        async with session.post(url, **kwargs) as r:
+            if r.status >= 400:
+                raise APIError(r.status, await r.text(), r.headers)
+            async for line in r.content:
+                line = line.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:") :].strip()
+                if data == "[DONE]":
+                    return
+                yield json.loads(data)
+
+    async def aclose(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
 
     @abstractmethod
     def rotate_key(self):
@@ -14,3 +316,14 @@ class Base(ABC):
     @abstractmethod
     def translate(self, text):
         pass
+
+    # the async versions of a translator that is not `is_async` run the
+    # blocking ones in the default executor of the event loop
+
+    async def atranslate(self, text):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.translate, text)
+
+    async def atranslate_list(self, plist):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.translate_list, plist)
@@ -0,0 +1,220 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from book_maker.metrics import metrics
+from book_maker.utils import normalize_text
+
+
+class TranslationCache:
+    """
+    translation memory persisted in a SQLite file, shared by every run and book
+
+    Entries are keyed by a hash of the model, target language, prompt and the
+    normalized source text. When more than `max_size` entries are stored the
+    least recently used ones are evicted.
+    """
+
+    def __init__(self, path, max_size=100000):
+        path = os.path.expanduser(path)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS translations "
+            "(key TEXT PRIMARY KEY, translation TEXT NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS translations_last_used "
+            "ON translations (last_used)"
+        )
+        self.conn.commit()
+        self.size = self.conn.execute("SELECT COUNT(*) FROM translations").fetchone()[0]
+
+    @staticmethod
+    def make_key(*parts, text):
+        h = hashlib.sha256()
+        for part in parts:
+            h.update(str(part).encode("utf-8"))
+            h.update(b"\0")
+        h.update(normalize_text(text).encode("utf-8"))
+        return h.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT translation FROM translations WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                metrics.inc("cache_misses_total")
+                return None
+            self.hits += 1
+            metrics.inc("cache_hits_total")
+            self.conn.execute(
+                "UPDATE translations SET last_used = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            self.conn.commit()
+            return row[0]
+
+    def set(self, key, translation):
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO translations VALUES (?, ?, ?)",
+                (key, translation, time.time()),
+            )
+            if cursor.rowcount == 0:
+                self.conn.execute(
+                    "UPDATE translations SET translation = ?, last_used = ? WHERE key = ?",
+                    (translation, time.time(), key),
+                )
+            self.size += cursor.rowcount
+            if self.size > self.max_size:
+                self.conn.execute(
+                    "DELETE FROM translations WHERE key IN "
+                    "(SELECT key FROM translations ORDER BY last_used LIMIT ?)",
+                    (self.size - self.max_size,),
+                )
+                self.size = self.max_size
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def is_translation(text, t_text):
+    """whether `t_text` can be kept as the translation of `text`, an empty
+    answer or the source given back unchanged is not"""
+    if not isinstance(t_text, str) or not t_text.strip():
+        return False
+    return normalize_text(t_text) != normalize_text(text)
+
+
+class CachedTranslator:
+    """
+    wrap a translator so that cached translations skip the network, anything
+    else is delegated to the wrapped translator
+
+    Only answers that look like translations are cached, the others are
+    returned but asked again next time.
+    """
+
+    def __init__(self, translator, cache):
+        self.translator = translator
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.translator, name)
+
+    def _key(self, text):
+        t = self.translator
+        return self.cache.make_key(
+            type(t).__name__,
+            getattr(t, "model", ""),
+            t.language,
+            getattr(t, "system_content", ""),
+            getattr(t, "prompt_template", ""),
+            text=text,
+        )
+
+    def _store(self, key, text, t_text):
+        if is_translation(text, t_text):
+            self.cache.set(key, t_text)
+
+    @staticmethod
+    async def _in_executor(fn, *args):
+        # sqlite blocks, keep it off the event loop
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    def translate(self, text):
+        key = self._key(text)
+        t_text = self.cache.get(key)
+        if t_text is None:
+            t_text = self.translator.translate(text)
+            self._store(key, text, t_text)
+        return t_text
+
+    async def atranslate(self, text):
+        key = self._key(text)
+        t_text = await self._in_executor(self.cache.get, key)
+        if t_text is None:
+            t_text = await self.translator.atranslate(text)
+            await self._in_executor(self._store, key, text, t_text)
+        return t_text
+
+    def translate_list(self, plist, on_segment=None):
+        keys, result, missed = self._lookup_list(plist)
+        if not missed:
+            return result
+        on_missed = self._on_missed(missed, on_segment)
+        t_list = self.translator.translate_list(
+            [plist[i] for i in missed], **self._segment_kwargs(on_missed)
+        )
+        if len(t_list) != len(missed):
+            # the lines can not be told apart, translate the paragraphs one
+            # by one
+            t_list = []
+            for number, i in enumerate(missed):
+                t_list.append(self.translator.translate(plist[i]))
+                # in place of the segments streamed before
+                if on_missed is not None:
+                    on_missed(number, t_list[-1])
+        self._store_list(plist, keys, result, missed, t_list)
+        return result
+
+    async def atranslate_list(self, plist, on_segment=None):
+        keys, result, missed = await self._in_executor(self._lookup_list, plist)
+        if not missed:
+            return result
+        on_missed = self._on_missed(missed, on_segment)
+        t_list = await self.translator.atranslate_list(
+            [plist[i] for i in missed], **self._segment_kwargs(on_missed)
+        )
+        if len(t_list) != len(missed):
+            t_list = []
+            for number, i in enumerate(missed):
+                t_list.append(await self.translator.atranslate(plist[i]))
+                if on_missed is not None:
+                    on_missed(number, t_list[-1])
+        await self._in_executor(self._store_list, plist, keys, result, missed, t_list)
+        return result
+
+    @staticmethod
+    def _on_missed(missed, on_segment):
+        """`on_segment` for the segments of the missed paragraphs, numbered
+        among them by the wrapped translator"""
+        if on_segment is None:
+            return None
+
+        def on_missed(number, t_text):
+            if number < len(missed):
+                on_segment(missed[number], t_text)
+
+        return on_missed
+
+    @staticmethod
+    def _segment_kwargs(on_missed):
+        # translators without streaming do not take on_segment
+        return {} if on_missed is None else {"on_segment": on_missed}
+
+    def _lookup_list(self, plist):
+        keys = [self._key(text) for text in plist]
+        result = [self.cache.get(key) for key in keys]
+        missed = [i for i, t_text in enumerate(result) if t_text is None]
+        return keys, result, missed
+
+    def _store_list(self, plist, keys, result, missed, t_list):
+        for i, t_text in zip(missed, t_list):
+            self._store(keys[i], plist[i], t_text)
+            result[i] = t_text
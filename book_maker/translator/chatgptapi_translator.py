@@ -1,72 +1,287 @@
-import time
+import logging
+from os import environ
 
 import openai
-from os import environ
 
-from .base_translator import Base
+from .base_translator import Base, classify_error
+
+logger = logging.getLogger(__name__)
+
+# between the paragraphs of a batch, in the prompt and in the answer
+BATCH_SEPARATOR = "\n\n\n\n\n"
+
+
+class OutputTooLong(Exception):
+    """a batch was cut off by the token limit or ran away"""
+
+
+class StreamCollector:
+    """
+    put a streamed completion back together, a runaway output is stopped as
+    soon as it goes over `limit` chunks
+
+    Every segment of a batch is handed to `on_segment(number, segment)` as
+    soon as the separator after it arrives, the last one is only in the
+    completion.
+    """
+
+    def __init__(self, limit, on_segment=None):
+        # chunks, about one token each, before the output counts as runaway
+        self.limit = limit
+        self.on_segment = on_segment
+        self.parts = []
+        self.pending = ""
+        self.segments = 0
+        self.chunks = 0
+        self.finish_reason = None
+
+    def feed(self, chunk):
+        choice = chunk["choices"][0]
+        self.finish_reason = choice.get("finish_reason") or self.finish_reason
+        delta = (choice.get("delta") or {}).get("content") or ""
+        self.chunks += 1
+        if self.chunks > self.limit:
+            raise OutputTooLong(f"the output ran over {self.limit} tokens")
+        self.parts.append(delta)
+        if self.on_segment is None:
+            return
+        self.pending += delta
+        while BATCH_SEPARATOR in self.pending:
+            segment, self.pending = self.pending.split(BATCH_SEPARATOR, 1)
+            # the separator can come with more newlines around it
+            self.pending = self.pending.lstrip("\n")
+            segment = segment.strip()
+            if segment:
+                self.on_segment(self.segments, segment)
+                self.segments += 1
+
+    def completion(self):
+        return {
+            "choices": [
+                {
+                    "message": {"content": "".join(self.parts)},
+                    "finish_reason": self.finish_reason,
+                }
+            ],
+            # a stream has no usage, count a token per chunk
+            "usage": {"completion_tokens": self.chunks},
+        }
 
 
 class ChatGPTAPI(Base):
+    is_async = True
+    # stream the completions, see StreamCollector
+    stream = False
+    # a streamed output longer than this many times the expected one is
+    # stopped as runaway
+    runaway_factor = 4
+
     def __init__(self, key, language, api_base=None):
         super().__init__(key, language)
-        self.key_len = len(key.split(","))
-        if api_base:
-            openai.api_base = api_base
+        self.model = "gpt-3.5-turbo"
+        self.system_content = environ.get("OPENAI_API_SYS_MSG") or ""
+        self.prompt_template = "Please help me to translate,`{text}` to {language}, please return only translated content not include the origin text"
+        # passed with every request rather than set on the openai module
+        self.api_base = (api_base or openai.api_base).rstrip("/")
 
-    def rotate_key(self):
-        openai.api_key = next(self.keys)
+    def rotate_key(self, tokens=0):
+        return self.keys.acquire(tokens)
 
-    def get_translation(self, text):
-        self.rotate_key()
-        completion = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {
-                    "role": "system",
-                    "content": environ.get("OPENAI_API_SYS_MSG") or "",
-                },
-                {
-                    "role": "user",
-                    "content": f"Please help me to translate,`{text}` to {self.language}, please return only translated content not include the origin text",
-                },
-            ],
+    def _messages(self, text):
+        return [
+            {
+                "role": "system",
+                "content": self.system_content,
+            },
+            {
+                "role": "user",
+                "content": self.prompt_template.format(
+                    text=text, language=self.language
+                ),
+            },
+        ]
+
+    def _estimate(self, text, messages):
+        # corrected with the real usage once the response is back
+        return sum(
+            self.count_tokens(m["content"]) for m in messages
+        ) + self.expected_output_tokens(text)
+
+    def _collector(self, text, on_segment):
+        return StreamCollector(
+            self.expected_output_tokens(text) * self.runaway_factor + 64, on_segment
         )
-        t_text = (
+
+    @staticmethod
+    def _content(completion):
+        return (
             completion["choices"][0]
             .get("message")
             .get("content")
             .encode("utf8")
             .decode()
         )
-        return t_text
+
+    def complete(self, text, on_segment=None, stream=None):
+        """the chat completion translating `text`, streamed unless `stream` is
+        False, the segments of a streamed batch are handed to `on_segment` as
+        they arrive"""
+        messages = self._messages(text)
+        estimated_tokens = self._estimate(text, messages)
+        stream = self.stream if stream is None else stream
+
+        def request(key):
+            # pass the key and base per request instead of setting the module
+            # globals of openai, so translations can run from several threads
+            completion = openai.ChatCompletion.create(
+                api_key=key,
+                api_base=self.api_base,
+                model=self.model,
+                messages=messages,
+                request_timeout=self.timeout,
+                stream=stream,
+            )
+            if stream:
+                collector = self._collector(text, on_segment)
+                try:
+                    for chunk in completion:
+                        collector.feed(chunk)
+                finally:
+                    # stop reading the response when the output is aborted
+                    completion.close()
+                completion = collector.completion()
+            self.record_usage(key, completion.get("usage"), text, estimated_tokens)
+            return completion
+
+        return self.call_with_retry(request, estimated_tokens)
+
+    async def acomplete(self, text, on_segment=None, stream=None):
+        messages = self._messages(text)
+        estimated_tokens = self._estimate(text, messages)
+        stream = self.stream if stream is None else stream
+        url = f"{self.api_base}/chat/completions"
+        body = {"model": self.model, "messages": messages}
+
+        async def request(key):
+            headers = {"Authorization": f"Bearer {key}"}
+            if stream:
+                collector = self._collector(text, on_segment)
+                chunks = self.apost_stream(
+                    url, headers=headers, json={**body, "stream": True}
+                )
+                try:
+                    async for chunk in chunks:
+                        collector.feed(chunk)
+                finally:
+                    await chunks.aclose()
+                completion = collector.completion()
+            else:
+                completion = await self.apost(url, headers=headers, json=body)
+            self.record_usage(key, completion.get("usage"), text, estimated_tokens)
+            return completion
+
+        return await self.acall_with_retry(request, estimated_tokens)
+
+    def get_translation(self, text):
+        try:
+            completion = self.complete(text)
+        except OutputTooLong as e:
+            # a single paragraph can not be split, a runaway stream is sent
+            # again once and the whole answer waited for
+            logger.warning("%s, sending it again without streaming", e)
+            completion = self.complete(text, stream=False)
+        return self._content(completion)
+
+    async def aget_translation(self, text):
+        try:
+            completion = await self.acomplete(text)
+        except OutputTooLong as e:
+            logger.warning("%s, sending it again without streaming", e)
+            completion = await self.acomplete(text, stream=False)
+        return self._content(completion)
 
     def translate(self, text):
-        # todo: Determine whether to print according to the cli option
-        print(text)
+        logger.debug(text)
+        t_text = self.get_translation(text)
+        logger.debug(t_text)
+        return t_text
 
+    async def atranslate(self, text):
+        logger.debug(text)
+        t_text = await self.aget_translation(text)
+        logger.debug(t_text)
+        return t_text
+
+    def translate_list(self, plist, on_segment=None):
+        """
+        translate the paragraphs in one request, one line each
+
+        With `stream` every paragraph of the answer is handed to
+        `on_segment(number, text)` as soon as the separator after it arrives.
+        They are not checked yet, the number of lines of the whole answer can
+        still differ from the number of paragraphs.
+        """
+        if len(plist) == 1:
+            return [self.get_translation(plist[0])]
         try:
-            t_text = self.get_translation(text)
+            new_str = self.join_list(plist)
+            logger.debug(new_str)
+            completion = self.complete(new_str, on_segment)
+            self.check_batch(plist, completion)
         except Exception as e:
-            # todo: better sleep time? why sleep alawys about key_len
-            # 1. openai server error or own network interruption, sleep for a fixed time
-            # 2. an apikey has no money or reach limit, don’t sleep, just replace it with another apikey
-            # 3. all apikey reach limit, then use current sleep
-            sleep_time = int(60 / self.key_len)
-            print(e, f"will sleep {sleep_time} seconds")
-            time.sleep(sleep_time)
-
-            t_text = self.get_translation(text)
-
-        # todo: Determine whether to print according to the cli option
-        print(t_text)
-        return t_text
+            if not self.is_too_long(e):
+                raise
+            # too long for the model, translate the halves on their own
+            half = len(plist) // 2
+            return self.translate_list(plist[:half], on_segment) + self.translate_list(
+                plist[half:], self.shifted(on_segment, half)
+            )
+        resultStr = self._content(completion)
+        logger.debug(resultStr)
+        return self.split_result(resultStr)
 
-    def translate_list(self, plist):
-        sep = "\n\n\n\n\n"
-        new_str = sep.join([item.text for item in plist])
-        resultStr = self.translate(new_str)
+    async def atranslate_list(self, plist, on_segment=None):
+        if len(plist) == 1:
+            return [await self.aget_translation(plist[0])]
+        try:
+            new_str = self.join_list(plist)
+            logger.debug(new_str)
+            completion = await self.acomplete(new_str, on_segment)
+            self.check_batch(plist, completion)
+        except Exception as e:
+            if not self.is_too_long(e):
+                raise
+            half = len(plist) // 2
+            return await self.atranslate_list(
+                plist[:half], on_segment
+            ) + await self.atranslate_list(plist[half:], self.shifted(on_segment, half))
+        resultStr = self._content(completion)
+        logger.debug(resultStr)
+        return self.split_result(resultStr)
 
+    @staticmethod
+    def shifted(on_segment, offset):
+        """`on_segment` for the paragraphs of a batch from `offset` on"""
+        if on_segment is None:
+            return None
+        return lambda number, text: on_segment(number + offset, text)
+
+    @staticmethod
+    def check_batch(plist, completion):
+        # the paragraphs after the cut would be left untranslated
+        if len(plist) > 1 and completion["choices"][0].get("finish_reason") == "length":
+            raise OutputTooLong("the output was cut off by the token limit")
+
+    @staticmethod
+    def is_too_long(e):
+        return isinstance(e, OutputTooLong) or classify_error(e) == "context_length"
+
+    @staticmethod
+    def join_list(plist):
+        return BATCH_SEPARATOR.join(plist)
+
+    @staticmethod
+    def split_result(resultStr):
         lines = resultStr.split("\n")
         lines = [line.strip() for line in lines if line.strip() != ""]
-
         return lines
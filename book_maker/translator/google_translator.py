@@ -1,6 +1,22 @@
+import logging
+import re
+
 import requests
 
-from .base_translator import Base
+from book_maker.utils import TO_LANGUAGE_CODE
+
+from .base_translator import Base, Lines
+
+logger = logging.getLogger(__name__)
+
+# google uses region codes for the two chinese scripts
+GOOGLE_LANGUAGE_CODES = {"zh-hans": "zh-CN", "zh-hant": "zh-TW"}
+
+
+def google_language_code(language):
+    """the google code of a language given by name or code"""
+    code = TO_LANGUAGE_CODE.get(language.lower(), language)
+    return GOOGLE_LANGUAGE_CODES.get(code, code)
 
 
 class Google(Base):
@@ -8,9 +24,13 @@ class Google(Base):
     google translate
     """
 
+    is_async = True
+    # google refuses to translate much more text at once
+    max_batch_chars = 5000
+
     def __init__(self, key, language, api_base=None):
         super().__init__(key, language)
-        self.api_url = "https://translate.google.com/translate_a/single?client=it&dt=qca&dt=t&dt=rmt&dt=bd&dt=rms&dt=sos&dt=md&dt=gt&dt=ld&dt=ss&dt=ex&otf=2&dj=1&hl=en&ie=UTF-8&oe=UTF-8&sl=auto&tl=zh-CN"
+        self.api_url = f"https://translate.google.com/translate_a/single?client=it&dt=qca&dt=t&dt=rmt&dt=bd&dt=rms&dt=sos&dt=md&dt=gt&dt=ld&dt=ss&dt=ex&otf=2&dj=1&hl=en&ie=UTF-8&oe=UTF-8&sl=auto&tl={google_language_code(language)}"
         self.headers = {
             "Content-Type": "application/x-www-form-urlencoded",
             "User-Agent": "GoogleTranslate/6.29.59279 (iPhone; iOS 15.4; en; iPhone14,2)",
@@ -22,17 +42,110 @@ class Google(Base):
     def rotate_key(self):
         pass
 
+    @staticmethod
+    def _body(text):
+        return "q={text}".format(text=requests.utils.quote(text))
+
+    @staticmethod
+    def _join_sentences(result):
+        return "".join([sentence.get("trans", "") for sentence in result["sentences"]])
+
+    def _post(self, text):
+        def request(key):
+            r = self.session.post(
+                self.api_url,
+                headers=self.headers,
+                data=self._body(text),
+                timeout=self.timeout,
+            )
+            r.raise_for_status()
+            return r.json()
+
+        return self.call_with_retry(request)
+
+    async def _apost(self, text):
+        async def request(key):
+            return await self.apost(
+                self.api_url, headers=self.headers, data=self._body(text)
+            )
+
+        return await self.acall_with_retry(request)
+
     def translate(self, text):
-        print(text)
-        r = self.session.post(
-            self.api_url,
-            headers=self.headers,
-            data="q={text}".format(text=requests.utils.quote(text)),
-        )
-        if not r.ok:
-            return text
-        t_text = "".join(
-            [sentence.get("trans", "") for sentence in r.json()["sentences"]]
-        )
-        print(t_text)
+        logger.debug(text)
+        t_text = self._join_sentences(self._post(text))
+        logger.debug(t_text)
+        return t_text
+
+    async def atranslate(self, text):
+        logger.debug(text)
+        t_text = self._join_sentences(await self._apost(text))
+        logger.debug(t_text)
         return t_text
+
+    def _pack(self, plist):
+        """
+        split the paragraphs into batches of up to `max_batch_chars`, each
+        paragraph on one line
+        """
+        batch = []
+        size = 0
+        for text in plist:
+            text = re.sub(r"\s+", " ", text).strip()
+            if batch and size + len(text) + 1 > self.max_batch_chars:
+                yield batch
+                batch = []
+                size = 0
+            batch.append(text)
+            size += len(text) + 1
+        if batch:
+            yield batch
+
+    @staticmethod
+    def _split_sentences(result, count):
+        """
+        the translations of the lines of a batch, google splits its answer
+        into sentences and a sentence ending a line ends with a newline in its
+        original text. None when they do not add up to `count` lines.
+        """
+        lines = [""]
+        for sentence in result["sentences"]:
+            if "trans" not in sentence:
+                # transliterations come as extra entries without a translation
+                continue
+            lines[-1] += sentence["trans"]
+            if sentence.get("orig", "").endswith("\n"):
+                lines.append("")
+        if not lines[-1].strip():
+            lines.pop()
+        if len(lines) != count:
+            return None
+        return [line.strip() for line in lines]
+
+    def translate_list(self, plist):
+        """translate the paragraphs with as few requests as possible"""
+        t_list = []
+        for batch in self._pack(plist):
+            logger.debug("%s", Lines(batch))
+            result = self._split_sentences(self._post("\n".join(batch)), len(batch))
+            if result is None:
+                # the lines could not be told apart, send them one by one
+                result = [self._join_sentences(self._post(text)) for text in batch]
+            logger.debug("%s", Lines(result))
+            t_list.extend(result)
+        return t_list
+
+    async def atranslate_list(self, plist):
+        t_list = []
+        for batch in self._pack(plist):
+            logger.debug("%s", Lines(batch))
+            result = self._split_sentences(
+                await self._apost("\n".join(batch)), len(batch)
+            )
+            if result is None:
+                result = [
+                    self._join_sentences(await self._apost(text)) for text in batch
+                ]
+            logger.debug("%s", Lines(result))
+            t_list.extend(result)
+        return t_list
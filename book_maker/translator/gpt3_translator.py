@@ -1,10 +1,22 @@
+import logging
+import re
+
 import requests
-from rich import print
 
-from .base_translator import Base
+from .base_translator import Base, Lines
+
+logger = logging.getLogger(__name__)
 
 
 class GPT3(Base):
+    is_async = True
+    # tokens of the prompt and completion together
+    context_size = 4097
+    # prompts the completions endpoint takes in one request
+    max_batch_prompts = 20
+    # how many times a truncated translation is split again
+    max_splits = 3
+
     def __init__(self, key, language, api_base=None):
         super().__init__(key, language)
         self.api_url = (
@@ -16,26 +28,169 @@ class GPT3(Base):
             "Content-Type": "application/json",
         }
         # TODO support more models here
+        self.model = "text-davinci-003"
+        self.prompt_template = "Please help me to translate，`{text}` to {language}"
         self.data = {
-            "prompt": "",
-            "model": "text-davinci-003",
-            "max_tokens": 1024,
+            "model": self.model,
             "temperature": 1,
             "top_p": 1,
         }
         self.session = requests.session()
         self.language = language
 
-    def rotate_key(self):
-        self.headers["Authorization"] = f"Bearer {next(self.keys)}"
+    def rotate_key(self, tokens=0):
+        return self.keys.acquire(tokens)
+
+    def _prepare(self, texts):
+        prompts = [
+            self.prompt_template.format(text=text, language=self.language)
+            for text in texts
+        ]
+        prompt_tokens = [self.count_tokens(prompt) for prompt in prompts]
+        # enough room for the longest translation expected, within the context
+        max_tokens = max(self.expected_output_tokens(text) for text in texts)
+        max_tokens = min(
+            max_tokens * 3 // 2 + 16, self.context_size - max(prompt_tokens)
+        )
+        # build the body per request, self.data is shared between workers
+        data = {**self.data, "prompt": prompts, "max_tokens": max(max_tokens, 16)}
+        estimated_tokens = sum(prompt_tokens) + sum(
+            self.expected_output_tokens(text) for text in texts
+        )
+        return data, estimated_tokens
+
+    def _headers(self, key):
+        return {**self.headers, "Authorization": f"Bearer {key}"}
+
+    @staticmethod
+    def _choices(result, count):
+        """the (text, finish_reason) of every prompt, by the index of its choice"""
+        choices = [("", None)] * count
+        for choice in result.get("choices") or []:
+            choices[choice["index"]] = (
+                choice.get("text", "").strip(),
+                choice.get("finish_reason"),
+            )
+        return choices
+
+    def _complete(self, texts):
+        data, estimated_tokens = self._prepare(texts)
+
+        def request(key):
+            r = self.session.post(
+                self.api_url,
+                headers=self._headers(key),
+                json=data,
+                timeout=self.timeout,
+            )
+            r.raise_for_status()
+            result = r.json()
+            self.record_usage(
+                key, result.get("usage"), " ".join(texts), estimated_tokens
+            )
+            return result
+
+        return self._choices(
+            self.call_with_retry(request, estimated_tokens), len(texts)
+        )
+
+    async def _acomplete(self, texts):
+        data, estimated_tokens = self._prepare(texts)
+
+        async def request(key):
+            result = await self.apost(
+                self.api_url, headers=self._headers(key), json=data
+            )
+            self.record_usage(
+                key, result.get("usage"), " ".join(texts), estimated_tokens
+            )
+            return result
+
+        result = await self.acall_with_retry(request, estimated_tokens)
+        return self._choices(result, len(texts))
+
+    @staticmethod
+    def _halves(text):
+        """`text` split in two at the sentence end or space nearest to its
+        middle, or alone when it can not be split"""
+
+        def inside(ends):
+            # both halves keep some text
+            return [end for end in ends if text[:end].strip() and text[end:].strip()]
+
+        ends = inside(m.end() for m in re.finditer(r"[.!?。！？]\s*", text))
+        if not ends:
+            ends = inside(m.start() for m in re.finditer(r"\s", text))
+        if not ends:
+            return [text]
+        middle = min(ends, key=lambda end: abs(end - len(text) // 2))
+        return [text[:middle].strip(), text[middle:].strip()]
+
+    def _truncated(self, texts, choices, splits):
+        """the texts whose translation was cut off by max_tokens, as
+        (index, halves), they are translated again in smaller pieces"""
+        if splits >= self.max_splits:
+            return []
+        redo = []
+        for i, (_, finish_reason) in enumerate(choices):
+            if finish_reason == "length":
+                halves = self._halves(texts[i])
+                if len(halves) == 2:
+                    redo.append((i, halves))
+        return redo
+
+    @staticmethod
+    def _merge(choices, redo, translated):
+        result = [t_text for t_text, _ in choices]
+        for k, (i, _) in enumerate(redo):
+            result[i] = " ".join(translated[2 * k : 2 * k + 2])
+        return result
+
+    def _translate_texts(self, texts, splits=0):
+        result = []
+        for start in range(0, len(texts), self.max_batch_prompts):
+            batch = texts[start : start + self.max_batch_prompts]
+            choices = self._complete(batch)
+            redo = self._truncated(batch, choices, splits)
+            pieces = [half for _, halves in redo for half in halves]
+            translated = self._translate_texts(pieces, splits + 1) if pieces else []
+            result.extend(self._merge(choices, redo, translated))
+        return result
+
+    async def _atranslate_texts(self, texts, splits=0):
+        result = []
+        for start in range(0, len(texts), self.max_batch_prompts):
+            batch = texts[start : start + self.max_batch_prompts]
+            choices = await self._acomplete(batch)
+            redo = self._truncated(batch, choices, splits)
+            pieces = [half for _, halves in redo for half in halves]
+            translated = (
+                await self._atranslate_texts(pieces, splits + 1) if pieces else []
+            )
+            result.extend(self._merge(choices, redo, translated))
+        return result
 
     def translate(self, text):
-        print(text)
-        self.rotate_key()
-        self.data["prompt"] = f"Please help me to translate，`{text}` to {self.language}"
-        r = self.session.post(self.api_url, headers=self.headers, json=self.data)
-        if not r.ok:
-            return text
-        t_text = r.json().get("choices")[0].get("text", "").strip()
-        print(t_text)
+        logger.debug(text)
+        t_text = self._translate_texts([text])[0]
+        logger.debug(t_text)
+        return t_text
+
+    async def atranslate(self, text):
+        logger.debug(text)
+        t_text = (await self._atranslate_texts([text]))[0]
+        logger.debug(t_text)
         return t_text
+
+    def translate_list(self, plist):
+        """translate the paragraphs with one prompt each, many prompts a request"""
+        logger.debug("%s", Lines(plist))
+        t_list = self._translate_texts(list(plist))
+        logger.debug("%s", Lines(t_list))
+        return t_list
+
+    async def atranslate_list(self, plist):
+        logger.debug("%s", Lines(plist))
+        t_list = await self._atranslate_texts(list(plist))
+        logger.debug("%s", Lines(t_list))
+        return t_list
@@ -0,0 +1,158 @@
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    a bucket refilled continuously at `rate_per_minute`, holding at most one
+    minute worth of tokens, None means no limit
+    """
+
+    def __init__(self, rate_per_minute=None):
+        self.capacity = rate_per_minute
+        self.tokens = rate_per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if self.capacity is None:
+            return
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated) * self.capacity / 60,
+        )
+        self.updated = now
+
+    def headroom(self, now):
+        """fraction of the bucket that is still available"""
+        if self.capacity is None:
+            return 1.0
+        self._refill(now)
+        return max(self.tokens, 0) / self.capacity
+
+    def wait_time(self, amount, now):
+        """seconds until `amount` tokens are available"""
+        if self.capacity is None:
+            return 0
+        self._refill(now)
+        # a request bigger than the whole bucket only waits for a full one
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) * 60 / self.capacity
+
+    def consume(self, amount):
+        if self.capacity is not None:
+            self.tokens -= amount
+
+
+class KeyScheduler:
+    """
+    pick an api key for every request, keeping each key under its own
+    requests/minute and tokens/minute limits
+
+    The key with the most headroom left is used, so keys of different tiers
+    are loaded according to their limits. `acquire` only blocks when every key
+    is saturated, until the first one has room again.
+    """
+
+    def __init__(self, keys, rpm=None, tpm=None):
+        self.keys = list(keys)
+        rpm = self._per_key(rpm)
+        tpm = self._per_key(tpm)
+        self.requests = {k: TokenBucket(r) for k, r in zip(self.keys, rpm)}
+        self.tokens = {k: TokenBucket(t) for k, t in zip(self.keys, tpm)}
+        self.blocked_until = dict.fromkeys(self.keys, 0)
+        self.disabled = set()
+        # ties are broken by the least recently used key, without any limit
+        # configured this is the same round robin as before. Uses are counted
+        # rather than timed, a coarse clock gives several requests one time
+        self.last_used = {k: i - len(self.keys) for i, k in enumerate(self.keys)}
+        self.uses = 0
+        self.lock = threading.Lock()
+
+    def _per_key(self, limits):
+        if not limits:
+            return [None] * len(self.keys)
+        if len(limits) == 1:
+            return list(limits) * len(self.keys)
+        if len(limits) != len(self.keys):
+            raise Exception("the number of rate limits must match the number of keys")
+        return list(limits)
+
+    def _wait_time(self, key, tokens, now):
+        return max(
+            self.blocked_until[key] - now,
+            self.requests[key].wait_time(1, now),
+            self.tokens[key].wait_time(tokens, now),
+        )
+
+    def _headroom(self, key, now):
+        return min(self.requests[key].headroom(now), self.tokens[key].headroom(now))
+
+    def _reserve(self, tokens):
+        """take a key that is ready and return it with 0, or return None and
+        the seconds until one is"""
+        with self.lock:
+            keys = [k for k in self.keys if k not in self.disabled]
+            if not keys:
+                raise Exception("no usable api key left")
+            now = time.monotonic()
+            waits = {k: self._wait_time(k, tokens, now) for k in keys}
+            ready = [k for k in keys if waits[k] <= 0]
+            if not ready:
+                return None, min(waits.values())
+            key = max(
+                ready,
+                key=lambda k: (self._headroom(k, now), -self.last_used[k]),
+            )
+            self.requests[key].consume(1)
+            self.tokens[key].consume(tokens)
+            self.uses += 1
+            self.last_used[key] = self.uses
+            return key, 0
+
+    def acquire(self, tokens=0):
+        """
+        block until a key can take a request of about `tokens` tokens
+        (prompt and completion) and return it
+        """
+        while True:
+            key, wait = self._reserve(tokens)
+            if key is not None:
+                return key
+            time.sleep(wait)
+
+    async def aacquire(self, tokens=0):
+        """like `acquire`, waiting without blocking the event loop"""
+        while True:
+            key, wait = self._reserve(tokens)
+            if key is not None:
+                return key
+            await asyncio.sleep(wait)
+
+    def adjust(self, key, tokens):
+        """correct the estimate given to `acquire` once the real usage is known"""
+        with self.lock:
+            self.tokens[key].consume(tokens)
+
+    def cool_down(self, key, seconds):
+        """do not hand out `key` for the next `seconds`, e.g. after a 429"""
+        with self.lock:
+            self.blocked_until[key] = max(
+                self.blocked_until[key], time.monotonic() + seconds
+            )
+
+    def disable(self, key):
+        """stop handing out `key`, e.g. when it is invalid or out of quota"""
+        with self.lock:
+            self.disabled.add(key)
+
+    def __len__(self):
+        return len(self.keys) - len(self.disabled)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.acquire()
@@ -1,3 +1,6 @@
+import re
+import unicodedata
+
 # Borrowed from : https://github.com/openai/whisper
 LANGUAGES = {
     "en": "english",
@@ -117,3 +120,8 @@ TO_LANGUAGE_CODE = {
     "sinhalese": "si",
     "castilian": "es",
 }
+
+
+def normalize_text(text):
+    """collapse whitespace and unicode forms, so equal looking texts compare equal"""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
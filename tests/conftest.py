@@ -0,0 +1,48 @@
+import os
+import shutil
+
+import pytest
+
+BOOKS = os.path.join(os.path.dirname(__file__), "..", "test_books")
+
+
+class FakeModel:
+    """a translator answering without the network, "<text>" for `text`"""
+
+    is_async = False
+    stream = False
+
+    def __init__(self, key, language, api_base=None):
+        self.language = language
+        self.requests = []
+
+    def translate(self, text):
+        self.requests.append(text)
+        return f"<{text}>"
+
+    def translate_list(self, plist):
+        self.requests.append(list(plist))
+        return [f"<{text}>" for text in plist]
+
+    def count_tokens(self, text):
+        return len(text) // 4 + 1
+
+    def expected_output_tokens(self, text):
+        return self.count_tokens(text)
+
+
+@pytest.fixture
+def fake_model():
+    return FakeModel
+
+
+@pytest.fixture
+def book(tmp_path):
+    """copy a book of test_books to a temporary directory"""
+
+    def copy(name):
+        path = tmp_path / name
+        shutil.copy(os.path.join(BOOKS, name), path)
+        return str(path)
+
+    return copy
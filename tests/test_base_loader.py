@@ -0,0 +1,124 @@
+import asyncio
+
+import pytest
+
+from book_maker.loader.base_loader import BaseBookLoader
+
+
+class Loader(BaseBookLoader):
+    def __init__(self, model, workers=1, accumulated_num=10, output_num=100):
+        self.translate_model = model("key", "French")
+        self.workers = workers
+        self.accumulated_num = accumulated_num
+        self.accumulated_output_num = output_num
+
+    _make_new_book = make_bilingual_book = load_state = lambda self: None
+    _save_temp_book = _save_progress = lambda self: None
+
+
+@pytest.fixture
+def dropping_model(fake_model):
+    class DroppingModel(fake_model):
+        """answers a batch of more than two paragraphs without its last line"""
+
+        def translate_list(self, plist):
+            t_list = super().translate_list(plist)
+            return t_list[:-1] if len(t_list) > 2 else t_list
+
+    return DroppingModel
+
+
+def test_pack_batches_under_both_budgets(fake_model):
+    # every text counts 2 tokens in and out
+    loader = Loader(fake_model, accumulated_num=5, output_num=100)
+    items = [(i, "abcd") for i in range(5)]
+    assert [len(b) for b in loader._pack_batches(items)] == [2, 2, 1]
+    loader = Loader(fake_model, accumulated_num=100, output_num=6)
+    assert [len(b) for b in loader._pack_batches(items)] == [3, 2]
+
+
+def test_pack_batches_sends_a_long_paragraph_alone(fake_model):
+    loader = Loader(fake_model, accumulated_num=5)
+    items = [(0, "a"), (1, "a" * 40), (2, "a")]
+    assert [[k for k, _ in b] for b in loader._pack_batches(items)] == [
+        [0],
+        [1],
+        [2],
+    ]
+
+
+def test_translate_in_order_keeps_the_order(fake_model):
+    jobs = [(i, f"p{i}") for i in range(20)] + [("end", None)]
+    for workers in (1, 4):
+        loader = Loader(fake_model, workers=workers)
+        assert list(loader._translate_in_order(iter(jobs))) == [
+            (i, f"<p{i}>") for i in range(20)
+        ] + [("end", None)]
+
+
+def test_async_requests_are_no_more_than_the_workers(fake_model):
+    class AsyncModel(fake_model):
+        is_async = True
+        running = peak = 0
+
+        async def atranslate(self, text):
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+            await asyncio.sleep(0.01)
+            self.running -= 1
+            return self.translate(text)
+
+    loader = Loader(AsyncModel, workers=2)
+    jobs = [(i, f"p{i}") for i in range(10)]
+    assert list(loader._translate_in_order(jobs)) == [(i, f"<p{i}>") for i in range(10)]
+    assert loader.translate_model.peak == 2
+
+
+def test_batch_with_missing_lines_is_split(dropping_model):
+    loader = Loader(dropping_model)
+    texts = [f"p{i}" for i in range(5)]
+    ((_, t_list),) = loader._translate_in_order([(None, texts)])
+    assert t_list == [f"<{text}>" for text in texts]
+    # 5 -> 2 + 3 -> 2 + 1 + 2
+    assert loader.translate_model.requests[1:] == [
+        ["p0", "p1"],
+        ["p2", "p3", "p4"],
+        "p2",
+        ["p3", "p4"],
+    ]
+
+
+def test_streamed_batch_with_missing_lines_is_dropped(dropping_model):
+    class StreamingModel(dropping_model):
+        stream = True
+
+        def translate_list(self, plist, on_segment=None):
+            t_list = super().translate_list(plist)
+            if on_segment is not None:
+                for number, t_text in enumerate(t_list):
+                    on_segment(number, t_text)
+            return t_list
+
+    loader = Loader(StreamingModel)
+    events = []
+    jobs = [("a", ["p0", "p1", "p2"]), ("b", ["p3", "p4"]), ("c", "p5")]
+    results = list(
+        loader._translate_in_order(
+            jobs,
+            on_segment=lambda *args: events.append(args),
+            on_drop=lambda payload: events.append(("drop", payload)),
+        )
+    )
+    assert [t_list for _, t_list in results] == [
+        ["<p0>", "<p1>", "<p2>"],
+        ["<p3>", "<p4>"],
+        "<p5>",
+    ]
+    # the parts of a dropped batch are not streamed
+    assert events == [
+        ("a", 0, "<p0>"),
+        ("a", 1, "<p1>"),
+        ("drop", "a"),
+        ("b", 0, "<p3>"),
+        ("b", 1, "<p4>"),
+    ]
@@ -0,0 +1,159 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+
+from book_maker.translator.base_translator import (
+    APIError,
+    Base,
+    classify_error,
+    retry_after,
+)
+
+
+class Response:
+    """what requests raises its errors with"""
+
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+
+    def json(self):
+        return self.body
+
+
+class HTTPError(Exception):
+    def __init__(self, response):
+        super().__init__(response.status_code)
+        self.response = response
+
+
+class Timeout(Exception):
+    pass
+
+
+def test_api_error_reads_the_error_body():
+    e = APIError(400, '{"error": {"code": "bad", "message": "no"}}')
+    assert (e.http_status, e.code, str(e)) == (400, "bad", "400 no")
+    assert str(APIError(502, "<html>")) == "502 <html>"
+
+
+@pytest.mark.parametrize(
+    "error, kind",
+    [
+        (APIError(429, "slow down"), "rate_limit"),
+        (APIError(503, "down"), "server"),
+        (APIError(401, "bad key"), "auth"),
+        (APIError(429, '{"error": {"code": "insufficient_quota"}}'), "auth"),
+        (
+            APIError(400, '{"error": {"code": "context_length_exceeded"}}'),
+            "context_length",
+        ),
+        (
+            Exception("This model's maximum context length is 4097 tokens"),
+            "context_length",
+        ),
+        (HTTPError(Response(429)), "rate_limit"),
+        (HTTPError(Response(400, {"error": {"code": "insufficient_quota"}})), "auth"),
+        (Timeout(), "timeout"),
+        (asyncio.TimeoutError(), "timeout"),
+        (ConnectionResetError(), "timeout"),
+        (APIError(400, "bad request"), "other"),
+        (ValueError("bug"), "other"),
+    ],
+)
+def test_classify_error(error, kind):
+    assert classify_error(error) == kind
+
+
+def test_classify_aiohttp_errors():
+    aiohttp = pytest.importorskip("aiohttp")
+    assert classify_error(aiohttp.ServerDisconnectedError()) == "timeout"
+
+
+def test_retry_after():
+    assert retry_after(APIError(429, "", {"retry-after": "7"})) == 7
+    assert retry_after(APIError(429, "", {"retry-after-ms": "250"})) == 0.25
+    assert retry_after(HTTPError(Response(429, headers={"retry-after": "3"}))) == 3
+    later = datetime.now(timezone.utc) + timedelta(seconds=30)
+    seconds = retry_after(APIError(429, "", {"retry-after": format_datetime(later)}))
+    assert 25 < seconds <= 30
+    past = format_datetime(datetime.now(timezone.utc) - timedelta(seconds=30))
+    assert retry_after(APIError(429, "", {"retry-after": past})) == 0
+    assert retry_after(APIError(429, "")) is None
+    assert retry_after(APIError(429, "", {"retry-after": "soon"})) is None
+
+
+class Translator(Base):
+    # retries without waiting
+    backoff_base = 0
+
+    def rotate_key(self):
+        pass
+
+    def translate(self, text):
+        pass
+
+
+def failing(*errors):
+    """a request failing with `errors` in turn, then answering with its key"""
+    keys = []
+
+    def request(key):
+        keys.append(key)
+        if len(keys) <= len(errors):
+            raise errors[len(keys) - 1]
+        return key
+
+    return request, keys
+
+
+def test_retry_transient_errors():
+    request, keys = failing(APIError(500, "oops"), Timeout())
+    assert Translator("a", "French").call_with_retry(request) == "a"
+    assert keys == ["a", "a", "a"]
+
+
+def test_do_not_retry_other_errors():
+    request, keys = failing(APIError(400, "bad request"))
+    with pytest.raises(APIError):
+        Translator("a", "French").call_with_retry(request)
+    assert keys == ["a"]
+
+
+def test_give_up_after_max_retries():
+    translator = Translator("a", "French")
+    translator.max_retries = 2
+    request, keys = failing(*[APIError(500, "oops")] * 5)
+    with pytest.raises(APIError):
+        translator.call_with_retry(request)
+    assert len(keys) == 3
+
+
+def test_rate_limited_key_rests_and_another_one_is_used():
+    translator = Translator("a,b", "French")
+    request, keys = failing(APIError(429, "slow down", {"retry-after": "30"}))
+    assert translator.call_with_retry(request) == "b"
+    assert keys == ["a", "b"]
+    assert translator.keys.blocked_until["a"] > translator.keys.blocked_until["b"]
+
+
+def test_invalid_key_is_dropped():
+    translator = Translator("a,b", "French")
+    request, keys = failing(APIError(401, "bad key"))
+    assert translator.call_with_retry(request) == "b"
+    assert len(translator.keys) == 1
+
+
+def test_async_retry():
+    errors = [APIError(502, "bad gateway")]
+
+    async def request(key):
+        if errors:
+            raise errors.pop()
+        return key
+
+    translator = Translator("a", "French")
+    assert asyncio.run(translator.acall_with_retry(request)) == "a"
@@ -0,0 +1,91 @@
+import asyncio
+
+from book_maker.translator.cache import (
+    CachedTranslator,
+    TranslationCache,
+    is_translation,
+)
+
+
+class FakeTranslator:
+    language = "fr"
+
+    def __init__(self, drop_line=False):
+        self.drop_line = drop_line
+        self.requests = []
+
+    def translate(self, text):
+        self.requests.append(text)
+        # a name is given back as it is
+        return text if text == "Boa" else f"<{text}>"
+
+    def translate_list(self, plist):
+        self.requests.append(list(plist))
+        t_list = [f"<{text}>" for text in plist]
+        return t_list[:-1] if self.drop_line else t_list
+
+    async def atranslate(self, text):
+        return self.translate(text)
+
+    async def atranslate_list(self, plist):
+        return self.translate_list(plist)
+
+
+def make_cached(tmp_path, **kwargs):
+    cache = TranslationCache(str(tmp_path / "cache.sqlite3"))
+    return CachedTranslator(FakeTranslator(**kwargs), cache), cache
+
+
+def test_is_translation():
+    assert is_translation("hello", "bonjour")
+    assert not is_translation("hello", "")
+    assert not is_translation("hello", "  ")
+    assert not is_translation("hello", None)
+    assert not is_translation("hello  world", "hello world")
+
+
+def test_translation_is_cached(tmp_path):
+    translator, cache = make_cached(tmp_path)
+    assert translator.translate("hello") == "<hello>"
+    assert translator.translate("hello") == "<hello>"
+    assert translator.translator.requests == ["hello"]
+    assert cache.hits == 1
+
+
+def test_source_given_back_is_not_cached(tmp_path):
+    translator, _ = make_cached(tmp_path)
+    assert translator.translate("Boa") == "Boa"
+    assert translator.translate("Boa") == "Boa"
+    assert translator.translator.requests == ["Boa", "Boa"]
+
+
+def test_list_only_sends_missed_paragraphs(tmp_path):
+    translator, _ = make_cached(tmp_path)
+    translator.translate("b")
+    assert translator.translate_list(["a", "b", "c"]) == ["<a>", "<b>", "<c>"]
+    assert translator.translator.requests == ["b", ["a", "c"]]
+
+
+def test_list_mismatch_falls_back_to_paragraphs(tmp_path):
+    translator, _ = make_cached(tmp_path, drop_line=True)
+    assert translator.translate_list(["a", "b", "c"]) == ["<a>", "<b>", "<c>"]
+    assert translator.translator.requests == [["a", "b", "c"], "a", "b", "c"]
+    # the paragraphs translated one by one are cached
+    assert translator.translate_list(["a", "b", "c"]) == ["<a>", "<b>", "<c>"]
+    assert len(translator.translator.requests) == 4
+
+
+def test_async_list(tmp_path):
+    translator, _ = make_cached(tmp_path, drop_line=True)
+    result = asyncio.run(translator.atranslate_list(["a", "b"]))
+    assert result == ["<a>", "<b>"]
+    assert asyncio.run(translator.atranslate("a")) == "<a>"
+    assert translator.translator.requests == [["a", "b"], "a", "b"]
+
+
+def test_eviction(tmp_path):
+    cache = TranslationCache(str(tmp_path / "cache.sqlite3"), max_size=2)
+    for i in range(3):
+        cache.set(f"k{i}", f"t{i}")
+    assert cache.get("k0") is None
+    assert cache.get("k2") == "t2"
@@ -0,0 +1,52 @@
+import pytest
+
+from book_maker.translator.chatgptapi_translator import (
+    BATCH_SEPARATOR,
+    ChatGPTAPI,
+    OutputTooLong,
+    StreamCollector,
+)
+
+
+def chunk(content, finish_reason=None):
+    return {
+        "choices": [{"delta": {"content": content}, "finish_reason": finish_reason}]
+    }
+
+
+def test_stream_collector_hands_over_every_finished_segment():
+    segments = []
+    collector = StreamCollector(100, lambda *args: segments.append(args))
+    answer = BATCH_SEPARATOR.join(["un", "deux", "trois"])
+    # the separator is cut between chunks
+    for i in range(0, len(answer), 3):
+        collector.feed(chunk(answer[i : i + 3]))
+    collector.feed(chunk("", "stop"))
+    assert segments == [(0, "un"), (1, "deux")]
+    completion = collector.completion()
+    assert completion["choices"][0]["message"]["content"] == answer
+    assert completion["choices"][0]["finish_reason"] == "stop"
+
+
+def test_stream_collector_stops_a_runaway_output():
+    collector = StreamCollector(3)
+    for _ in range(3):
+        collector.feed(chunk("a"))
+    with pytest.raises(OutputTooLong):
+        collector.feed(chunk("a"))
+
+
+def test_runaway_paragraph_is_sent_again_without_streaming(monkeypatch):
+    translator = ChatGPTAPI("key", "French")
+    translator.stream = True
+    calls = []
+
+    def complete(text, on_segment=None, stream=None):
+        calls.append(stream)
+        if stream is None:
+            raise OutputTooLong("the output ran over 100 tokens")
+        return {"choices": [{"message": {"content": "un"}}]}
+
+    monkeypatch.setattr(translator, "complete", complete)
+    assert translator.translate("one") == "un"
+    assert calls == [None, False]
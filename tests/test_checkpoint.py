@@ -0,0 +1,97 @@
+import json
+
+from book_maker.loader.checkpoint import CheckpointJournal, OffsetCheckpoint, text_hash
+
+
+def test_text_hash_ignores_spacing():
+    assert text_hash("a  b\n") == text_hash("a b")
+    assert text_hash("a b") != text_hash("a c")
+
+
+def test_journal_finds_translations_by_href_and_hash(tmp_path):
+    journal = CheckpointJournal(str(tmp_path / "journal"))
+    journal.open()
+    journal.append("a.xhtml", 0, "one", "un")
+    journal.append("a.xhtml", 1, "two", "deux")
+    journal.append("b.xhtml", 0, "one", "une")
+    journal.close()
+    assert journal.translations() == {
+        ("a.xhtml", text_hash("one")): "un",
+        ("a.xhtml", text_hash("two")): "deux",
+        ("b.xhtml", text_hash("one")): "une",
+    }
+
+
+def test_journal_buffers_until_the_flush_interval(tmp_path):
+    journal = CheckpointJournal(str(tmp_path / "journal"), flush_interval=3600)
+    journal.open()
+    journal.append("a.xhtml", 0, "one", "un")
+    assert journal.load() == []
+    journal.flush()
+    assert len(journal.load()) == 1
+    journal.close()
+
+
+def test_journal_skips_a_line_cut_by_a_crash(tmp_path):
+    journal = CheckpointJournal(str(tmp_path / "journal"))
+    journal.open()
+    journal.append("a.xhtml", 0, "one", "un")
+    journal.close()
+    with open(journal.path, "a", encoding="utf-8") as f:
+        f.write('{"href": "a.xhtml", "ind')
+    assert journal.translations() == {("a.xhtml", text_hash("one")): "un"}
+
+
+def test_journal_appends_on_resume(tmp_path):
+    journal = CheckpointJournal(str(tmp_path / "journal"))
+    journal.open()
+    journal.append("a.xhtml", 0, "one", "un")
+    journal.close()
+    journal.open(append=True)
+    journal.append("a.xhtml", 1, "two", "deux")
+    journal.close()
+    assert len(journal.translations()) == 2
+    # a new run starts over
+    journal.open()
+    journal.close()
+    assert journal.translations() == {}
+
+
+def test_compact_keeps_the_last_record_of_a_segment(tmp_path):
+    journal = CheckpointJournal(str(tmp_path / "journal"))
+    journal.open()
+    journal.append("a.xhtml", 0, "one", "un")
+    journal.append("a.xhtml", 1, "two", "deux")
+    journal.append("a.xhtml", 0, "one", "une")
+    journal.compact()
+    with open(journal.path, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    assert [(r["index"], r["text"]) for r in records] == [(0, "une"), (1, "deux")]
+    assert not (tmp_path / "journal.tmp").exists()
+
+
+def test_journal_drops_the_segments_of_a_batch(tmp_path):
+    journal = CheckpointJournal(str(tmp_path / "journal"))
+    journal.open()
+    journal.append("a.xhtml", 0, "one", "deux", batch="run:a.xhtml:0")
+    journal.append("a.xhtml", 1, "two", "trois", batch="run:a.xhtml:0")
+    journal.append("a.xhtml", 2, "three", "trois", batch="run:a.xhtml:2")
+    journal.drop("run:a.xhtml:0")
+    journal.append("a.xhtml", 0, "one", "un")
+    journal.compact()
+    assert journal.translations() == {
+        ("a.xhtml", text_hash("one")): "un",
+        ("a.xhtml", text_hash("three")): "trois",
+    }
+    with open(journal.path, encoding="utf-8") as f:
+        assert not any("drop" in json.loads(line) for line in f)
+
+
+def test_offset_checkpoint(tmp_path):
+    checkpoint = OffsetCheckpoint(str(tmp_path / "state.json"))
+    assert checkpoint.load() is None
+    checkpoint.save({"offset": 10, "index": 2})
+    assert checkpoint.load() == {"offset": 10, "index": 2}
+    checkpoint.remove()
+    checkpoint.remove()
+    assert checkpoint.load() is None
@@ -0,0 +1,93 @@
+from book_maker.loader.epub_chapter import (
+    extract_texts,
+    parse_chapter,
+    render_chapter,
+    splice_translations,
+)
+
+# the <p> left open in the <li> holds "y" as well when only the <p> are built
+UNCLOSED = b"<html><body><p>one</p><ul><li><p>x</li><p>y</p></ul></body></html>"
+
+
+def render(content, translations, texts=None, parser="html.parser"):
+    return render_chapter(
+        content, ["p"], False, translations, parser=parser, texts=texts
+    ).decode()
+
+
+def test_selective_texts_are_matched_with_the_full_parse():
+    texts = extract_texts(UNCLOSED, ["p"])
+    assert texts == ["one", "xy", "y"]
+    translations = {i: text.upper() for i, text in enumerate(texts)}
+    for parser in ("html.parser", "lxml"):
+        html = render(UNCLOSED, translations, texts, parser)
+        assert "<p>ONE</p>" in html
+        assert "<p>Y</p>" in html
+        assert "XY" not in html
+        # the translation of "y" follows it, not "x"
+        assert html.index("<p>Y</p>") > html.index("<p>y</p>")
+
+
+def splice(markup, translations, tags=("p",)):
+    soup, p_list = parse_chapter(markup, list(tags))
+    return splice_translations(markup, p_list, translations)
+
+
+def test_splice_keeps_the_markup():
+    markup = '<body>\n  <p class="a">one</p>\n  <p>two <b>bold</b></p>\n</body>'
+    assert splice(markup, {0: "un", 1: "deux"}) == (
+        '<body>\n  <p class="a">one</p><p class="a">un</p>\n'
+        "  <p>two <b>bold</b></p><p>deux</p>\n</body>"
+    )
+
+
+def test_splice_attributes_and_ruby():
+    markup = (
+        '<body><p title="a > b">one<ruby>漢<rt>かん</rt></ruby></p>' "\n<p>two</p></body>"
+    )
+    assert splice(markup, {0: "un", 1: "deux"}) == (
+        '<body><p title="a > b">one<ruby>漢<rt>かん</rt></ruby></p>'
+        '<p title="a &gt; b">un</p>\n<p>two</p><p>deux</p></body>'
+    )
+
+
+def test_splice_gives_up_on_what_could_hide_an_end_tag():
+    for markup in (
+        '<body><p title="a </p> b">one</p><p>two</p></body>',
+        "<body><p>one<!-- </p> --></p><p>two</p></body>",
+        '<body><p>one<script>"</p>"</script></p><p>two</p></body>',
+        "<body><p>one</p><![CDATA[</p>]]><p>two</p></body>",
+    ):
+        assert splice(markup, {0: "un", 1: "deux"}) is None
+        # the tree is serialized instead
+        html = render(markup.encode(), {0: "un", 1: "deux"})
+        assert html.index(">un</p>") < html.index("<p>two</p>")
+        assert html.endswith("<p>two</p><p>deux</p></body>")
+
+
+def test_splice_nested_elements_of_the_same_name():
+    markup = "<body><div>one<div>inner</div>end</div><div>two</div></body>"
+    html = splice(markup, {0: "un"}, tags=("div",))
+    assert html == markup.replace("end</div>", "end</div><div>un</div>", 1)
+
+
+def test_splice_gives_up_on_an_element_without_end_tag():
+    markup = "<body><div><p>one</div><p>two</p></body>"
+    assert splice(markup, {0: "un"}) is None
+    # the tree is serialized instead
+    html = render(markup.encode(), {0: "un"})
+    assert "<p>un</p>" in html
+
+
+def test_render_in_the_declared_encoding():
+    markup = (
+        '<?xml version="1.0" encoding="iso-8859-1"?>\n'
+        "<html><body><p>café</p></body></html>"
+    )
+    content = render_chapter(markup.encode("iso-8859-1"), ["p"], False, {0: "咖啡"})
+    assert content.decode("iso-8859-1") == markup.replace(
+        "café</p>", "café</p><p>&#21654;&#21857;</p>"
+    )
+    # UTF-8 without a declaration
+    content = render_chapter(b"<p>caf\xc3\xa9</p>", ["p"], False, {0: "咖啡"})
+    assert content.decode("utf-8") == "<p>café</p><p>咖啡</p>"
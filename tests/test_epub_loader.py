@@ -0,0 +1,140 @@
+import os
+import re
+import zipfile
+
+import pytest
+from ebooklib import ITEM_DOCUMENT
+
+from book_maker.loader.epub_loader import EPUBBookLoader
+from book_maker.loader.epub_stream import read_epub
+
+
+def make_loader(path, model, resume=False, **kwargs):
+    return EPUBBookLoader(path, model, "key", resume, "French", **kwargs)
+
+
+def documents(path):
+    book = read_epub(path)
+    return b"".join(item.content for item in book.get_items_of_type(ITEM_DOCUMENT))
+
+
+def test_failed_close_rebuilds_temp_book(book, fake_model, monkeypatch):
+    path = book("lemo.epub")
+    replace = os.replace
+
+    def failing_replace(src, dst):
+        # the zip is closed already when the book is moved in place
+        if dst.endswith("_bilingual.epub"):
+            raise OSError("disk full")
+        return replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", failing_replace)
+    loader = make_loader(path, fake_model, is_test=True, test_num=3)
+    with pytest.raises(SystemExit):
+        loader.make_bilingual_book()
+
+    base = path[: -len(".epub")]
+    assert not os.path.exists(f"{base}_bilingual.epub.part")
+    assert not os.path.exists(f"{base}_bilingual.epub")
+    assert loader.translate_model.requests
+
+    # the same book as a run that did not fail
+    monkeypatch.setattr(os, "replace", replace)
+    os.rename(f"{base}_bilingual_temp.epub", f"{base}_rebuilt.epub")
+    make_loader(path, fake_model, is_test=True, test_num=3).make_bilingual_book()
+    assert documents(f"{base}_rebuilt.epub") == documents(f"{base}_bilingual.epub")
+    assert documents(f"{base}_rebuilt.epub") != documents(path)
+
+
+def test_test_num_counts_batched_paragraphs(book, fake_model):
+    path = book("animal_farm.epub")
+    loader = make_loader(
+        path, fake_model, is_test=True, test_num=30, accumulated_num=200
+    )
+    loader.make_bilingual_book()
+    requests = loader.translate_model.requests
+    assert any(isinstance(r, list) for r in requests)
+    sent = sum(len(r) if isinstance(r, list) else 1 for r in requests)
+    assert sent <= 30
+
+
+def sent(model):
+    return sum(len(r) if isinstance(r, list) else 1 for r in model.requests)
+
+
+@pytest.mark.parametrize("accumulated_num", [1, 200])
+def test_resume_translates_only_what_is_left(book, fake_model, accumulated_num):
+    path = book("animal_farm.epub")
+    base = path[: -len(".epub")]
+    kwargs = {"is_test": True, "test_num": 40, "accumulated_num": accumulated_num}
+    loader = make_loader(path, fake_model, **kwargs)
+    loader.make_bilingual_book()
+    expected = sent(loader.translate_model)
+    os.rename(f"{base}_bilingual.epub", f"{base}_expected.epub")
+
+    class InterruptedModel(fake_model):
+        def translate(self, text):
+            if len(self.requests) >= 4:
+                raise KeyboardInterrupt
+            return super().translate(text)
+
+        def translate_list(self, plist):
+            if len(self.requests) >= 4:
+                raise KeyboardInterrupt
+            return super().translate_list(plist)
+
+    first = make_loader(path, InterruptedModel, **kwargs)
+    with pytest.raises(SystemExit):
+        first.make_bilingual_book()
+    assert len(first.translate_model.requests) == 4
+    resumed = make_loader(path, fake_model, resume=True, **kwargs)
+    resumed.make_bilingual_book()
+    assert sent(first.translate_model) + sent(resumed.translate_model) == expected
+    assert documents(f"{base}_bilingual.epub") == documents(f"{base}_expected.epub")
+
+
+def test_resume_keeps_the_segments_streamed_before_a_stop(book, fake_model):
+    path = book("animal_farm.epub")
+    base = path[: -len(".epub")]
+    kwargs = {"is_test": True, "test_num": 40, "accumulated_num": 200}
+    loader = make_loader(path, fake_model, **kwargs)
+    loader.make_bilingual_book()
+    expected = sent(loader.translate_model)
+    os.rename(f"{base}_bilingual.epub", f"{base}_expected.epub")
+
+    class StoppedModel(fake_model):
+        stream = True
+
+        def translate_list(self, plist, on_segment=None):
+            # two paragraphs arrive, then the run is stopped
+            for number, text in enumerate(plist[:2]):
+                on_segment(number, f"<{text}>")
+            raise KeyboardInterrupt
+
+    first = make_loader(path, StoppedModel, **kwargs)
+    with pytest.raises(SystemExit):
+        first.make_bilingual_book()
+    resumed = make_loader(path, fake_model, resume=True, **kwargs)
+    resumed.make_bilingual_book()
+    assert sent(resumed.translate_model) == expected - 2
+    assert documents(f"{base}_bilingual.epub") == documents(f"{base}_expected.epub")
+
+
+def test_documents_are_written_as_rendered(book, fake_model):
+    path = book("lemo.epub")
+    make_loader(path, fake_model, is_test=True, test_num=5).make_bilingual_book()
+    source = zipfile.ZipFile(path)
+    written = zipfile.ZipFile(path.replace(".epub", "_bilingual.epub"))
+    names = {name.rsplit("/", 1)[-1]: name for name in written.namelist()}
+    translated = 0
+    for name in source.namelist():
+        if not name.endswith(".html"):
+            continue
+        content = written.read(names[name.rsplit("/", 1)[-1]])
+        # without the translations inserted the markup is the original one
+        original, n = re.subn(
+            rb"<(\w+)[^>]*>&lt;.*?&gt;</\1>", b"", content, flags=re.S
+        )
+        assert original == source.read(name)
+        translated += n
+    assert translated == 5
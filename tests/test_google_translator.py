@@ -0,0 +1,55 @@
+from book_maker.translator.google_translator import Google, google_language_code
+
+
+def sentence(orig, trans=None):
+    if trans is None:
+        # a transliteration, without a translation
+        return {"translit": orig}
+    return {"orig": orig, "trans": trans}
+
+
+def test_google_language_code():
+    assert google_language_code("zh-hans") == "zh-CN"
+    assert google_language_code("Simplified Chinese") == "zh-CN"
+    assert google_language_code("traditional chinese") == "zh-TW"
+    assert google_language_code("Japanese") == "ja"
+    assert google_language_code("ja") == "ja"
+
+
+def test_split_sentences_into_the_lines_of_the_batch():
+    result = {
+        "sentences": [
+            sentence("One. ", "Un. "),
+            sentence("Two.\n", "Deux.\n"),
+            sentence("Three.\n", "Trois.\n"),
+            sentence("Un. Deux. Trois."),
+            sentence("Four.", "Quatre."),
+        ]
+    }
+    assert Google._split_sentences(result, 3) == ["Un. Deux.", "Trois.", "Quatre."]
+
+
+def test_split_sentences_drops_a_trailing_empty_line():
+    result = {"sentences": [sentence("One.\n", "Un.\n"), sentence("Two.\n", "Deux.\n")]}
+    assert Google._split_sentences(result, 2) == ["Un.", "Deux."]
+
+
+def test_split_sentences_with_another_count_of_lines():
+    result = {"sentences": [sentence("One. Two.", "Un. Deux.")]}
+    assert Google._split_sentences(result, 2) is None
+
+
+def test_lines_not_told_apart_are_sent_one_by_one(monkeypatch):
+    translator = Google("key", "French")
+    posted = []
+
+    def post(text):
+        posted.append(text)
+        if "\n" in text:
+            # the newline between the paragraphs is lost
+            return {"sentences": [sentence("One. Two.", "Un. Deux.")]}
+        return {"sentences": [sentence(text, f"<{text}>")]}
+
+    monkeypatch.setattr(translator, "_post", post)
+    assert translator.translate_list(["One.", "Two."]) == ["<One.>", "<Two.>"]
+    assert posted == ["One.\nTwo.", "One.", "Two."]
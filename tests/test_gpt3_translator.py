@@ -0,0 +1,74 @@
+import pytest
+
+from book_maker.translator.gpt3_translator import GPT3
+
+
+@pytest.mark.parametrize(
+    "text, halves",
+    [
+        ("One. Two. Three. Four.", ["One. Two.", "Three. Four."]),
+        ("One two three four", ["One two", "three four"]),
+        # a sentence end or space at either end does not split it
+        ("One.", ["One."]),
+        (" One", [" One"]),
+        ("One two ", ["One", "two"]),
+        ("Onetwo", ["Onetwo"]),
+    ],
+)
+def test_halves(text, halves):
+    assert GPT3._halves(text) == halves
+
+
+def test_choices_are_put_back_in_the_order_of_the_prompts():
+    result = {
+        "choices": [
+            {"index": 2, "text": " trois", "finish_reason": "stop"},
+            {"index": 0, "text": "un\n", "finish_reason": "length"},
+        ]
+    }
+    assert GPT3._choices(result, 3) == [
+        ("un", "length"),
+        ("", None),
+        ("trois", "stop"),
+    ]
+
+
+@pytest.fixture
+def translator(monkeypatch):
+    """a translator cutting off the translation of a text of two words or more"""
+    translator = GPT3("key", "French")
+    translator.requests = []
+
+    def complete(texts):
+        translator.requests.append(texts)
+        return [
+            (f"<{text}>"[:4], "length") if " " in text else (f"<{text}>", "stop")
+            for text in texts
+        ]
+
+    monkeypatch.setattr(translator, "_complete", complete)
+    return translator
+
+
+def test_truncated_translations_are_split_and_merged(translator):
+    assert translator.translate_list(["One two.", "Three", "Four five"]) == [
+        "<One> <two.>",
+        "<Three>",
+        "<Four> <five>",
+    ]
+    assert translator.requests == [
+        ["One two.", "Three", "Four five"],
+        ["One", "two.", "Four", "five"],
+    ]
+
+
+def test_truncated_translations_are_split_max_splits_times(translator):
+    translator.max_splits = 2
+    words = "one two three four five six seven eight"
+    # the pieces still cut off after the last split are kept as they are
+    assert translator.translate(words) == "<one <thr <fiv <sev"
+    assert translator.requests == [
+        [words],
+        ["one two three four", "five six seven eight"],
+        ["one two", "three four", "five six", "seven eight"],
+    ]
@@ -0,0 +1,76 @@
+from collections import Counter
+
+import pytest
+
+from book_maker.translator import key_scheduler
+from book_maker.translator.key_scheduler import KeyScheduler
+
+
+class Clock:
+    """time.monotonic and time.sleep of the scheduler, sleeping moves it on"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept += seconds
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(key_scheduler, "time", clock)
+    return clock
+
+
+def test_round_robin_without_limits(clock):
+    keys = KeyScheduler(["a", "b", "c"])
+    assert [next(keys) for _ in range(6)] == ["a", "b", "c", "a", "b", "c"]
+    assert clock.slept == 0
+
+
+def test_keys_are_loaded_by_their_limits(clock):
+    keys = KeyScheduler(["a", "b"], rpm=[60, 30])
+    used = Counter(keys.acquire() for _ in range(90))
+    assert used == {"a": 60, "b": 30}
+    assert clock.slept == 0
+    # every key is saturated, the next request waits for the first one
+    assert keys.acquire() == "a"
+    assert clock.slept == pytest.approx(1)
+
+
+def test_tokens_per_minute(clock):
+    keys = KeyScheduler(["a"], tpm=[1000])
+    keys.acquire(600)
+    keys.acquire(400)
+    keys.acquire(300)
+    assert clock.slept == pytest.approx(18)
+    # more tokens used than estimated
+    keys.adjust("a", 1000)
+    keys.acquire(0)
+    assert clock.slept == pytest.approx(18 + 60)
+
+
+def test_cool_down_and_disable(clock):
+    keys = KeyScheduler(["a", "b"])
+    keys.cool_down("a", 30)
+    assert [keys.acquire() for _ in range(3)] == ["b", "b", "b"]
+    keys.disable("b")
+    assert len(keys) == 1
+    assert keys.acquire() == "a"
+    assert clock.slept == pytest.approx(30)
+    keys.disable("a")
+    with pytest.raises(Exception, match="no usable api key left"):
+        keys.acquire()
+
+
+def test_limits_must_match_the_keys():
+    with pytest.raises(Exception):
+        KeyScheduler(["a", "b", "c"], rpm=[10, 20])
+    keys = KeyScheduler(["a", "b"], rpm=[10])
+    assert keys.requests["b"].capacity == 10
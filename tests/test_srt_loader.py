@@ -0,0 +1,73 @@
+from book_maker.loader.srt_loader import SRTBookLoader
+
+FILM = """header
+
+1
+00:00:01,000 --> 00:00:02,000
+Hello there.
+
+2
+00:00:03,000 --> 00:00:04,000
+How are
+you?
+
+3
+00:00:05,000 --> 00:00:06,000
+
+4
+00:00:07,000 --> 00:00:08,000
+Bye.
+"""
+
+
+def make_loader(tmp_path, model, text=FILM, newline="\n"):
+    path = tmp_path / "film.srt"
+    path.write_bytes(text.replace("\n", newline).encode("utf-8"))
+    return SRTBookLoader(str(path), model, "key", False, "French", "p", False)
+
+
+def test_cues_keep_the_blocks_without_text(tmp_path, fake_model):
+    loader = make_loader(tmp_path, fake_model)
+    cues = [(blocks, text) for (_, blocks), text in loader._iter_cues(0)]
+    assert cues == [
+        ([["header"]], None),
+        ([["1", "00:00:01,000 --> 00:00:02,000", "Hello there."]], "Hello there."),
+        (
+            [
+                ["2", "00:00:03,000 --> 00:00:04,000", "How are", "you?"],
+                ["3", "00:00:05,000 --> 00:00:06,000"],
+            ],
+            "How are you?",
+        ),
+        ([["4", "00:00:07,000 --> 00:00:08,000", "Bye."]], "Bye."),
+    ]
+
+
+def test_translation_follows_the_text_of_its_cue(tmp_path, fake_model):
+    for newline in ("\n", "\r\n"):
+        loader = make_loader(tmp_path, fake_model, newline=newline)
+        loader.make_bilingual_book()
+        # the cues are sent in one window
+        assert loader.translate_model.requests == [
+            ["Hello there.", "How are you?", "Bye."]
+        ]
+        bilingual = (tmp_path / "film_bilingual.srt").read_text(encoding="utf-8")
+        assert bilingual == (
+            "header\n\n"
+            "1\n00:00:01,000 --> 00:00:02,000\nHello there.\n<Hello there.>\n\n"
+            "2\n00:00:03,000 --> 00:00:04,000\nHow are\nyou?\n<How are you?>\n\n"
+            "3\n00:00:05,000 --> 00:00:06,000\n\n"
+            "4\n00:00:07,000 --> 00:00:08,000\nBye.\n<Bye.>\n"
+        )
+
+
+def test_cues_are_sent_in_windows(tmp_path, fake_model):
+    text = "".join(
+        f"{i}\n00:00:{i:02},000 --> 00:00:{i:02},500\nline number {i}\n\n"
+        for i in range(1, 21)
+    )
+    loader = make_loader(tmp_path, fake_model, text)
+    # every cue counts 4 tokens
+    loader.accumulated_num = 20
+    loader.make_bilingual_book()
+    assert [len(r) for r in loader.translate_model.requests] == [5, 5, 5, 5]
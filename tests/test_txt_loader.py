@@ -0,0 +1,106 @@
+import textwrap
+
+import pytest
+
+from book_maker.loader.txt_loader import TXTBookLoader
+
+WORDS = "the quick brown fox jumps over the lazy dog and runs away".split()
+
+
+def make_loader(path, model, resume=False, **kwargs):
+    return TXTBookLoader(path, model, "key", resume, "French", "p", False, **kwargs)
+
+
+def sentences(n, seed=0):
+    words = [WORDS[(seed + i) % len(WORDS)] for i in range(n)]
+    return " ".join(words).capitalize() + "."
+
+
+def write(tmp_path, text):
+    path = tmp_path / "book.txt"
+    path.write_text(text, encoding="utf-8")
+    return str(path)
+
+
+def paragraphs(loader):
+    return [loader._join_lines(lines) for _, lines in loader._iter_paragraphs(0)]
+
+
+def test_wrapped_paragraphs_are_joined(tmp_path, fake_model):
+    source = [sentences(60 + 7 * i, i) for i in range(6)]
+    # a full line ending a sentence goes on in the next one
+    source.append("x" * 57 + " ends here. " + sentences(20))
+    text = "\n".join(textwrap.fill(p, 70) for p in source)
+    loader = make_loader(write(tmp_path, text), fake_model)
+    assert paragraphs(loader) == source
+    assert 60 <= loader.wrap_width <= 70
+
+
+def test_short_lines_and_indents_start_paragraphs(tmp_path, fake_model):
+    body = [sentences(60 + 7 * i, i) for i in range(5)]
+    text = "Chapter One\n" + "\n".join("  " + textwrap.fill(p, 70) for p in body)
+    loader = make_loader(write(tmp_path, text), fake_model)
+    assert paragraphs(loader) == ["Chapter One"] + body
+
+
+def test_lines_of_a_book_not_wrapped_are_paragraphs(tmp_path, fake_model):
+    source = [sentences(10 + 13 * i, i)[:-1] for i in range(12)]
+    loader = make_loader(write(tmp_path, "\n".join(source)), fake_model)
+    assert paragraphs(loader) == source
+    assert loader.wrap_width is None
+
+
+def test_blank_lines_and_page_numbers(tmp_path, fake_model):
+    text = "one\n\n12\ntwo\n\n\nthree"
+    loader = make_loader(write(tmp_path, text), fake_model)
+    assert paragraphs(loader) == ["one", "two", "three"]
+
+
+def test_resume_goes_on_from_the_saved_offset(tmp_path, fake_model):
+    text = "\n\n".join(textwrap.fill(sentences(30 + i, i), 70) for i in range(12))
+    path = write(tmp_path, text)
+    bilingual = tmp_path / "book_bilingual.txt"
+    loader = make_loader(path, fake_model)
+    loader.make_bilingual_book()
+    expected = bilingual.read_bytes()
+    bilingual.unlink()
+
+    class InterruptedModel(fake_model):
+        def translate(self, text):
+            if len(self.requests) >= 5:
+                raise KeyboardInterrupt
+            return super().translate(text)
+
+    first = make_loader(path, InterruptedModel)
+    with pytest.raises(SystemExit):
+        first.make_bilingual_book()
+    assert not bilingual.exists()
+    # written after the saved progress, dropped on resume
+    with open(tmp_path / "book_bilingual_temp.txt", "a", encoding="utf-8") as f:
+        f.write("\ncut off")
+    resumed = make_loader(path, fake_model, resume=True)
+    assert resumed.index == 5
+    resumed.make_bilingual_book()
+    assert len(resumed.translate_model.requests) == 12 - 5
+    assert bilingual.read_bytes() == expected
+    assert not (tmp_path / ".book.temp.json").exists()
+
+
+def test_resume_starts_over_when_the_book_changed(tmp_path, fake_model):
+    path = write(tmp_path, "one\n\ntwo")
+
+    class InterruptedModel(fake_model):
+        def translate(self, text):
+            if self.requests:
+                raise KeyboardInterrupt
+            return super().translate(text)
+
+    with pytest.raises(SystemExit):
+        make_loader(path, InterruptedModel).make_bilingual_book()
+    write(tmp_path, "one\n\ntwo\n\nthree")
+    resumed = make_loader(path, fake_model, resume=True)
+    assert resumed.index == 0
+    resumed.make_bilingual_book()
+    assert (tmp_path / "book_bilingual.txt").read_text(encoding="utf-8") == (
+        "one\n<one>\ntwo\n<two>\nthree\n<three>"
+    )